@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Micro benchmarks for the python side of coquille. They do not need vim or
+# coqtop: the protocol benchmarks run against mock_coqtop.py. Run all of them
+# with:
+#
+#   python autoload/bench.py
+#
+# or a subset by passing their names as arguments.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import gc
+import os
+import sys
+import time
+
+import coqtop as CT
+import sentences
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class UnslottedCommand(object):
+    "Same fields as coqtop.Command, but stored in a __dict__"
+    def __init__(self, end):
+        self.edit_id = CT.EditId(CT.Command.next_edit)
+        CT.Command.next_edit -= 1
+        self.state_id = None
+        self.state = CT.Command.SENT
+        self.end = end
+        self.msg_type = CT.Command.NONE
+        self.msg_start_offset = None
+        self.msg_start = None
+        self.msg_stop_offset = None
+        self.msg_stop = None
+        self.worker = None
+        self.index = None
+        self.text = None
+        self.normalized = None
+        self.text_hash = None
+        self.kept_state = None
+        self.submitted = None
+        self.started = None
+        self.finished = None
+
+def measure_memory(make, count):
+    "Returns the number of bytes allocated by [make(i) for i in range(count)]"
+    gc.collect()
+    tracemalloc.start()
+    try:
+        objs = [make(i) for i in range(count)]
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del objs
+    return size
+
+def bench_command_memory(count=100000):
+    if tracemalloc is None:
+        print("command_memory: skipped, tracemalloc is not available")
+        return
+    slotted = measure_memory(lambda i: CT.Command((i, 0, 0)), count)
+    unslotted = measure_memory(lambda i: UnslottedCommand((i, 0, 0)), count)
+    print("command_memory: %d commands" % count)
+    print("  slotted:   %8.1f bytes/command" % (slotted / count))
+    print("  __dict__:  %8.1f bytes/command" % (unslotted / count))
+
+def generate_source(lines):
+    "Returns a list of [lines] lines of coq source with comments and proofs"
+    chunk = [
+        "(* Lemma number %d, with a qualified name: Coq.Arith.PeanoNat.",
+        "   (* and a nested comment. *) *)",
+        "Lemma l%d : forall n : nat, Nat.add n 0 = n.",
+        "Proof.",
+        "  intro n.",
+        "",
+        "  - idtac \"a string. with dots\"; auto.",
+        "Qed.",
+    ]
+    result = []
+    i = 0
+    while len(result) < lines:
+        for l in chunk:
+            result.append(l % i if "%d" in l else l)
+        i += 1
+    return result[:lines]
+
+def bench_sentence_lexer(lines=50000):
+    buf = generate_source(lines)
+    start = time.time()
+    index = sentences.SentenceIndex(buf)
+    pos = (0, 0)
+    count = 0
+    while True:
+        pos = index.next_end(*pos)
+        if pos is None:
+            break
+        count += 1
+    elapsed = time.time() - start
+    print("sentence_lexer: %d lines, %d sentences" % (lines, count))
+    print("  %.3f s, %.0f lines/s" % (elapsed, lines / elapsed))
+
+mock_coqtop = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "mock_coqtop.py")
+
+def launch_mock(*mock_args):
+    "Returns a CoqTop connected to a mock_coqtop.py process"
+    ct = CT.CoqTop()
+    ct.coqtop_command = [sys.executable, mock_coqtop] + list(mock_args)
+    assert ct.restart_coq()
+    return ct
+
+def send_all(ct, queue):
+    "Sends queue through send_async and waits until it is done"
+    ct.send_async(queue)
+    while not ct.wait_for_result() & CT.CoqTop.SEND_DONE:
+        pass
+    ct.finish_send()
+
+def make_queue(count):
+    return [("Lemma l%d : True. " % i, (i, 1, 1)) for i in range(count)]
+
+def bench_coqtop_adds(count=2000):
+    ct = launch_mock()
+    start = time.time()
+    for (cmd, end) in make_queue(count):
+        ct.advance(cmd, end)
+    sequential = time.time() - start
+    ct.restart_coq()
+    start = time.time()
+    send_all(ct, make_queue(count))
+    background = time.time() - start
+    ct.kill_coqtop()
+    print("coqtop_adds: %d Add calls against mock_coqtop.py" % count)
+    print("  advance:    %8.0f Adds/s" % (count / sequential))
+    print("  send_async: %8.0f Adds/s" % (count / background))
+
+def bench_coqtop_feedback(count=500, messages=20):
+    ct = launch_mock("--messages", str(messages))
+    start = time.time()
+    send_all(ct, make_queue(count))
+    elapsed = time.time() - start
+    decoder = ct.decoder
+    ct.kill_coqtop()
+    print("coqtop_feedback: %d Adds with %d messages each" % (count, messages))
+    print("  %8.0f elements/s, %8.0f KiB/s" %
+          (decoder.elements_parsed / elapsed,
+           decoder.bytes_parsed / 1024 / elapsed))
+
+def bench_coqtop_rewind(count=2000, rewinds=200):
+    ct = launch_mock()
+    send_all(ct, make_queue(count))
+    start = time.time()
+    for i in range(rewinds):
+        ct.rewind(1)
+    one_step = (time.time() - start) / rewinds
+    start = time.time()
+    ct.rewind(count // 2)
+    half = time.time() - start
+    ct.kill_coqtop()
+    print("coqtop_rewind: %d commands" % count)
+    print("  1 step:        %8.3f ms" % (one_step * 1000))
+    print("  %5d steps:   %8.3f ms" % (count // 2, half * 1000))
+
+BENCHMARKS = [
+    ("command_memory", bench_command_memory),
+    ("sentence_lexer", bench_sentence_lexer),
+    ("coqtop_adds", bench_coqtop_adds),
+    ("coqtop_feedback", bench_coqtop_feedback),
+    ("coqtop_rewind", bench_coqtop_rewind),
+]
+
+def main(names):
+    for name, bench in BENCHMARKS:
+        if not names or name in names:
+            bench()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
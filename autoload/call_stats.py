@@ -0,0 +1,109 @@
+# Low overhead latency statistics for the calls made to coqtop.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import math
+
+class Histogram(object):
+    """
+    Counts durations in logarithmic buckets. Each bucket is 2^(1/8) (about 9%)
+    wider than the previous one, starting at 1 microsecond, so recording a
+    value is O(1) and the memory used does not depend on the number of
+    values.
+    """
+    BUCKETS_PER_DOUBLING = 8
+    MIN_VALUE = 1e-6
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def bucket(self, value):
+        if value <= self.MIN_VALUE:
+            return 0
+        return int(math.log(value / self.MIN_VALUE, 2) *
+                   self.BUCKETS_PER_DOUBLING) + 1
+
+    def bucket_limit(self, bucket):
+        "Returns the largest value that falls in bucket"
+        return self.MIN_VALUE * 2 ** (bucket / self.BUCKETS_PER_DOUBLING)
+
+    def record(self, value):
+        b = self.bucket(value)
+        if b >= len(self.counts):
+            self.counts.extend([0] * (b + 1 - len(self.counts)))
+        self.counts[b] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        "Returns an upper bound of the p-th percentile (0 <= p <= 100)"
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for b, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return min(self.bucket_limit(b), self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+class CallStats(object):
+    """
+    Latency histograms for each protocol call name. Each call is split into:
+      - wait: time blocked reading coqtop's output
+      - decode: time parsing the output and updating the command states
+      - callback: time spent in the feedback callback (vim redraws)
+      - total: time from sending the call until its answer was processed
+    """
+    PARTS = ("total", "wait", "decode", "callback")
+
+    def __init__(self):
+        # Maps a call name to a dict mapping each part to its Histogram
+        self.calls = {}
+
+    def record(self, name, total, wait, decode, callback):
+        hists = self.calls.get(name)
+        if hists is None:
+            hists = self.calls[name] = dict((p, Histogram())
+                                            for p in self.PARTS)
+        hists["total"].record(total)
+        hists["wait"].record(wait)
+        hists["decode"].record(decode)
+        hists["callback"].record(callback)
+
+    def to_json(self):
+        return dict((name, dict((p, h.to_json()) for p, h in hists.items()))
+                    for name, hists in self.calls.items())
+
+    def report(self):
+        "Returns a human readable table of the percentiles, in milliseconds"
+        lines = ["%-8s %-8s %7s %9s %9s %9s %9s" %
+                 ("call", "part", "count", "p50", "p90", "p99", "max")]
+        for name in sorted(self.calls):
+            hists = self.calls[name]
+            for part in self.PARTS:
+                h = hists[part]
+                lines.append("%-8s %-8s %7d %9.3f %9.3f %9.3f %9.3f" %
+                             (name if part == "total" else "", part, h.count,
+                              h.percentile(50) * 1000,
+                              h.percentile(90) * 1000,
+                              h.percentile(99) * 1000,
+                              h.max * 1000))
+        return "\n".join(lines)
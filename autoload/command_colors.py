@@ -0,0 +1,152 @@
+# Tracks the ranges of the source buffer that coquille colors, and updates
+# them from the events of CoqTop.pop_events.
+#
+# Each command colors the text from the end of the previous command to its own
+# end: as sent or checked depending on its state, and as a warning or error
+# for the part its message covers. Only the commands named by the events are
+# recomputed, so an update costs O(changed commands), not O(session length).
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import coqtop as CT
+
+# The names of the highlight groups, as used by coquille.vim
+SENT = 'coquille_sent'
+CHECKED = 'coquille_checked'
+WARNINGS = 'coquille_warnings'
+ERRORS = 'coquille_errors'
+SLOW = 'coquille_slow'
+
+# Convert 0-based (line, col, byte) tuples into 1-based tuples in the form
+# (line, byte)
+def make_vim_range(start, stop):
+    return ((start[0] + 1, start[2] + 1), (stop[0] + 1, stop[2] + 1))
+
+def is_dead(comm):
+    return comm.state in (CT.Command.REVERTED, CT.Command.ABANDONED)
+
+class CommandColors(object):
+    def __init__(self, convert_offset, slow_threshold=0):
+        # convert_offset(start, offset, end) converts a message offset
+        # relative to the command that spans from start to end into a
+        # (line, col, byte) tuple.
+        self.convert_offset = convert_offset
+        # Commands that took at least this many seconds to process are
+        # colored as slow. 0 disables it.
+        self.slow_threshold = slow_threshold
+        # The (group, range) pairs colored for each command, by index
+        self.drawn = []
+        # The number of leading commands that are neither reverted nor
+        # abandoned. Only these are colored as sent or checked.
+        self.live = 0
+        # If not None, only the first [visible] commands are colored as sent
+        # or checked. The others are checked ahead of the user.
+        self.visible = None
+
+    def colors(self, comm, prev, live):
+        "Returns the (group, range) pairs for comm, which follows prev"
+        if prev is None:
+            # The root command has no text
+            return []
+        result = []
+        if live and comm.state == CT.Command.SENT:
+            result.append((SENT, make_vim_range(prev.end, comm.end)))
+        elif live and comm.state == CT.Command.PROCESSED:
+            # Processed commands are colored as checked, even if they produced
+            # a warning or error message. The message range overrides it.
+            result.append((CHECKED, make_vim_range(prev.end, comm.end)))
+            duration = comm.duration()
+            if (self.slow_threshold > 0 and duration is not None and
+                    duration >= self.slow_threshold):
+                result.append((SLOW, make_vim_range(prev.end, comm.end)))
+        if comm.msg_type != CT.Command.NONE:
+            # Normalize the start and stop positions, if it hasn't been done
+            # yet.
+            if comm.msg_start_offset is not None and comm.msg_start is None:
+                comm.msg_start = self.convert_offset(prev.end,
+                                                     comm.msg_start_offset,
+                                                     comm.end)
+            if comm.msg_stop_offset is not None and comm.msg_stop is None:
+                comm.msg_stop = self.convert_offset(prev.end,
+                                                    comm.msg_stop_offset,
+                                                    comm.end)
+            start = comm.msg_start
+            stop = comm.msg_stop
+            if start == stop:
+                start = prev.end
+                stop = comm.end
+            group = WARNINGS if comm.msg_type == CT.Command.WARNING else ERRORS
+            result.append((group, make_vim_range(start, stop)))
+        return result
+
+    def update(self, coq_top, visible=None):
+        """
+        Applies the events from coq_top.pop_events(), and the change to the
+        [visible] count. Returns (removed, added), the lists of (group, range)
+        pairs to uncolor and then color.
+        """
+        removed = []
+        dirty = set()
+        comms = {}
+        for e in coq_top.pop_events():
+            if isinstance(e, CT.CommandsRemoved):
+                for pairs in self.drawn[e.index:]:
+                    removed.extend(pairs)
+                del self.drawn[e.index:]
+                dirty = set(i for i in dirty if i < e.index)
+                self.live = min(self.live, e.index)
+            else:
+                dirty.add(e.index)
+        if visible != self.visible:
+            # Recolor the commands between the old and new limit
+            limits = [len(self.drawn) if v is None else v
+                      for v in (self.visible, visible)]
+            dirty.update(range(min(limits),
+                               min(max(limits), len(self.drawn))))
+            self.visible = visible
+        if dirty:
+            if max(dirty) >= len(self.drawn):
+                self.drawn.extend([] for i in range(max(dirty) + 1 -
+                                                    len(self.drawn)))
+            comms = self.fetch(coq_top, dirty, comms)
+            # A command that died stops the sent and checked colors of all
+            # the commands after it.
+            dead = [i for i in dirty if i < self.live and is_dead(comms[i])]
+            if dead:
+                old_live = self.live
+                self.live = min(dead)
+                dirty.update(range(self.live + 1, old_live))
+                comms = self.fetch(coq_top, dirty, comms)
+            # Dead commands never come back to life, so only the commands
+            # named by the events can extend the live prefix.
+            while self.live in dirty and not is_dead(comms[self.live]):
+                self.live += 1
+        added = []
+        for i in sorted(dirty):
+            live = i < self.live and (visible is None or i < visible)
+            new = self.colors(comms[i], comms.get(i - 1), live)
+            old = self.drawn[i]
+            if new != old:
+                removed.extend(p for p in old if p not in new)
+                added.extend(p for p in new if p not in old)
+                self.drawn[i] = new
+        # A range that was removed then added again can stay as it is
+        kept = set(removed).intersection(added)
+        if kept:
+            removed = [p for p in removed if p not in kept]
+            added = [p for p in added if p not in kept]
+        return (removed, added)
+
+    def fetch(self, coq_top, dirty, comms):
+        """
+        Adds the commands of dirty, and the ones before them, to the comms dict
+        of commands by index.
+        """
+        wanted = set(dirty)
+        wanted.update(i - 1 for i in dirty if i > 0)
+        wanted.difference_update(comms)
+        wanted = sorted(wanted)
+        comms.update(zip(wanted, coq_top.get_commands_at(wanted)))
+        return comms
@@ -1,74 +1,160 @@
 #!/usr/bin/env python
 
 # To use this, rename coqtop into coqtop.real, then put this script in its
-# place. This script will save all xml communication with coqtop in a log file.
+# place. This script will save all xml communication with coqtop in a trace
+# file, which can be replayed with coqtop_replay.py.
+#
+# The trace is in the JSON lines format. The first line is a header:
+#   {"version": 1, "argv": [...]}
+# and every following line is one XML document sent to or received from
+# coqtop:
+#   {"time": <seconds since start>, "stream": "input" or "output",
+#    "data": "<call ...>...</call>"}
+#
+# Bytes are forwarded as soon as they are read. Splitting them into documents
+# and writing the trace happens on a separate thread, so a slow log never
+# delays coqtop or vim.
 
 from __future__ import print_function
 
+import json
 import os
 import subprocess
 import sys
 import threading
+import time
 import xml.parsers.expat
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 xml_io = "-ideslave" in sys.argv
 
-log = open("coq-xml-log-%d.txt" % os.getpid(), "w")
-print("Running %s" % sys.argv, file=log)
+log = open("coq-xml-log-%d.jsonl" % os.getpid(), "w")
+start_time = time.time()
+print(json.dumps({"version": 1, "argv": sys.argv}), file=log)
 log.flush()
 
+# Chunks read from either direction, as (name, time, data) tuples, waiting to
+# be written to the log. None tells the log thread to stop.
+log_queue = queue.Queue()
+
 # Fake the HTML entities. This does not link to the real html DTD so that expat
 # does not try to download the real DTD.
-coq_doc_type = """<!DOCTYPE html [
+coq_doc_type = b"""<!DOCTYPE coqtoproot [
 <!ENTITY nbsp ' '>
-]>"""
+]><coqtoproot>"""
 
-def get_doc_end(xml_buffer):
-    if not xml_io:
-        if len(xml_buffer):
-            return len(xml_buffer)
-        else:
-            return -1
-    parser = xml.parsers.expat.ParserCreate()
-    try:
-        parser.Parse(coq_doc_type + xml_buffer, True)
-        end = len(xml_buffer)
-    except xml.parsers.expat.ExpatError as e:
-        if e.message.startswith(xml.parsers.expat.errors.XML_ERROR_JUNK_AFTER_DOC_ELEMENT):
-            end = parser.ErrorByteIndex - len(coq_doc_type)
-        else:
-            end = -1
-    return end
+class DocFramer(object):
+    """
+    Splits one direction of the stream into its top level XML documents.
 
-def handle_input(name, from_fd, to_file):
-    xml_buffer = ""
+    A single expat parser is kept for the whole stream, and the documents are
+    wrapped in a fake root element, so each byte is parsed only once.
+    """
+    def __init__(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.depth = 0
+        # Bytes that do not belong to a complete document yet. A bytearray, so
+        # appending to it and removing the documents from its start are not
+        # quadratic in the document size.
+        self.buffer = bytearray()
+        # Stream offset of self.buffer[0]. The offsets used by expat also
+        # count coq_doc_type.
+        self.buffer_start = len(coq_doc_type)
+        # Stream offsets where documents ended during the current feed
+        self.ends = []
+        self.parser.Parse(coq_doc_type, False)
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+
+    def end_element(self, name):
+        if self.depth == 2:
+            self.ends.append(self.tag_end(self.parser.CurrentByteIndex))
+        self.depth -= 1
+
+    def tag_end(self, tag_start):
+        "Returns the stream offset after the tag that starts at tag_start"
+        data = self.buffer
+        i = tag_start - self.buffer_start
+        quote = None
+        while True:
+            c = data[i:i + 1]
+            if quote is not None:
+                if c == quote:
+                    quote = None
+            elif c in (b'"', b"'"):
+                quote = c
+            elif c == b'>':
+                return self.buffer_start + i + 1
+            i += 1
+
+    def feed(self, data):
+        "Returns the list of documents completed by data"
+        self.buffer += data
+        self.parser.Parse(data, False)
+        docs = []
+        for end in self.ends:
+            split = end - self.buffer_start
+            docs.append(bytes(self.buffer[:split]))
+            del self.buffer[:split]
+            self.buffer_start = end
+        self.ends = []
+        return docs
+
+def write_log():
+    framers = {}
     while True:
-        read = os.read(from_fd, 10000)
-        if read == "":
+        item = log_queue.get()
+        if item is None:
             break
-        xml_buffer += read
-        while True:
+        (name, read_time, data) = item
+        if xml_io and name not in framers:
+            framers[name] = DocFramer()
+        framer = framers.get(name)
+        if framer is None:
+            docs = [data]
+        else:
             try:
-                end = get_doc_end(xml_buffer)
+                docs = framer.feed(data)
             except xml.parsers.expat.ExpatError as e:
-                print("%s: Error parsing %s: %s" % (name, xml_buffer, e),
-                      file=log)
-                log.flush()
-                raise
-            if end != -1:
-                print("%s: %s" % (name, xml_buffer[0:end]), file=log)
-                log.flush()
-                to_file.write(xml_buffer[0:end])
-                to_file.flush()
-                xml_buffer = xml_buffer[end:]
-            else:
-                break
+                # Log the raw chunks of this direction from now on
+                print("%s: Error parsing: %s" % (name, e), file=sys.stderr)
+                docs = [framer.buffer]
+                framers[name] = None
+        for doc in docs:
+            entry = {"time": read_time, "stream": name,
+                     "data": doc.decode("utf-8", "replace")}
+            print(json.dumps(entry), file=log)
+        if log_queue.empty():
+            log.flush()
+    log.flush()
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+def handle_input(name, from_fd, to_file):
+    to_fd = to_file.fileno()
+    while True:
+        read = os.read(from_fd, 0x10000)
+        if not read:
+            break
+        log_queue.put((name, time.time() - start_time, read))
+        write_all(to_fd, read)
     to_file.close()
 
-real_coq = subprocess.Popen(args=([sys.argv[0] + ".real"] + sys.argv[1:]), 
+real_coq = subprocess.Popen(args=([sys.argv[0] + ".real"] + sys.argv[1:]),
                             stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE)
 
+log_thread = threading.Thread(target=write_log)
 input_thread = threading.Thread(target=handle_input,
                                 args=("input", sys.stdin.fileno(), real_coq.stdin))
 output_thread = threading.Thread(target=handle_input,
@@ -76,6 +162,7 @@ output_thread = threading.Thread(target=handle_input,
 # There is no good way to stop the input thread if real_coq exits early. So
 # start it as a daemon thread and let it get force aborted at the end.
 input_thread.daemon = True
+log_thread.start()
 input_thread.start()
 output_thread.start()
 
@@ -83,5 +170,7 @@ real_coq.wait()
 
 os.close(sys.stdin.fileno())
 output_thread.join()
+log_queue.put(None)
+log_thread.join()
 
 sys.exit(real_coq.returncode)
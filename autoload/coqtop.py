@@ -9,8 +9,13 @@ import xml.etree.ElementTree as ET
 import signal
 import sys
 import threading
+import time
 
-from collections import deque, namedtuple
+from bisect import bisect_right
+from collections import OrderedDict, deque, namedtuple
+
+import call_stats
+import sentences
 
 # Define unicode in python 3
 if isinstance(__builtins__, dict):
@@ -37,6 +42,19 @@ Goals = namedtuple('Goals', ['fg', 'bg', 'shelved', 'given_up'])
 Goal = namedtuple('Goal', ['id', 'hyp', 'ccl'])
 Evar = namedtuple('Evar', ['info'])
 
+# Events returned by CoqTop.pop_events. They name the commands that changed, by
+# their index in CoqTop.states, so the colors can be updated without walking
+# every command.
+#
+# A command was appended
+CommandAdded = namedtuple('CommandAdded', ['index'])
+# The state of a command changed
+StateChanged = namedtuple('StateChanged', ['index', 'state'])
+# The message type or location of a command changed
+MessageChanged = namedtuple('MessageChanged', ['index', 'msg_type'])
+# The commands at index and after were removed
+CommandsRemoved = namedtuple('CommandsRemoved', ['index'])
+
 def parse_response(xml):
     assert xml.tag == 'value'
     if xml.get('val') == 'good':
@@ -169,15 +187,113 @@ def encode_value(v):
 def ignore_sigint():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-def escape(cmd):
-    escaped = cmd.replace("&nbsp;", ' ') \
-              .replace("&apos;", '\'') \
-              .replace("&#40;", '(') \
-              .replace("&#41;", ')')
-    if isinstance(escaped, str):
-        return escaped
+def spawn_coqtop(command, args, cwd=None):
+    """
+    Starts [command] with [args] as a coqtop process in ideslave mode, in the
+    directory [cwd], or the current one
+    """
+    options = [ '-ideslave'
+              , '-main-channel'
+              , 'stdfds'
+              , '-async-proofs'
+              , 'on'
+              ]
+    if os.name == 'nt':
+        return subprocess.Popen(
+            command + options + list(args)
+          , stdin = subprocess.PIPE
+          , stdout = subprocess.PIPE
+          , stderr = subprocess.STDOUT
+          , cwd = cwd
+        )
     else:
-        return escaped.encode('ascii', 'xmlcharrefreplace')
+        return subprocess.Popen(
+            command + options + list(args)
+          , stdin = subprocess.PIPE
+          , stdout = subprocess.PIPE
+          , preexec_fn = ignore_sigint
+          , cwd = cwd
+        )
+
+def stop_coqtop(coqtop):
+    "Asks the coqtop process to exit, and waits until it did"
+    try:
+        coqtop.stdin.close()
+    except (OSError, IOError):
+        # coqtop already exited
+        pass
+    try:
+        coqtop.terminate()
+    except OSError:
+        pass
+    coqtop.wait()
+
+# Fake the HTML entities that coqtop emits. Declaring them in an internal DTD
+# subset lets expat expand them itself, instead of rewriting the text before
+# parsing.
+coq_doc_type = b"""<!DOCTYPE coqtoproot [
+<!ENTITY nbsp ' '>
+]>"""
+
+class XmlStreamDecoder(object):
+    """
+    Incrementally parses the stream of top level elements that coqtop writes
+    to its stdout.
+
+    The parser state is kept between calls to [feed], so every byte is only
+    parsed once. Each top level element (<value>, <feedback>, <message>) is
+    made available through [pop_elements] as soon as its closing tag is seen.
+    """
+
+    class _Target(object):
+        "Builds one ElementTree element per top level element"
+        def __init__(self, ready):
+            self.ready = ready
+            self.depth = 0
+            self.builder = None
+
+        def start(self, tag, attrib):
+            self.depth += 1
+            # Depth 1 is the fake <coqtoproot> that wraps the whole stream.
+            if self.depth == 2:
+                self.builder = ET.TreeBuilder()
+            if self.depth >= 2:
+                self.builder.start(tag, attrib)
+
+        def end(self, tag):
+            if self.depth >= 2:
+                self.builder.end(tag)
+            if self.depth == 2:
+                self.ready.append(self.builder.close())
+                self.builder = None
+            self.depth -= 1
+
+        def data(self, data):
+            if self.depth >= 2:
+                self.builder.data(data)
+
+        def close(self):
+            return None
+
+    def __init__(self):
+        self.ready = deque()
+        self.parser = ET.XMLParser(target=self._Target(self.ready))
+        self.parser.feed(coq_doc_type + b'<coqtoproot>')
+        # Statistics
+        self.bytes_parsed = 0
+        self.elements_parsed = 0
+
+    def feed(self, data):
+        "Parses the next chunk of raw (utf-8 encoded) bytes from coqtop"
+        self.bytes_parsed += len(data)
+        self.parser.feed(data)
+
+    def pop_elements(self):
+        "Returns the list of top level elements completed since the last call"
+        elts = list(self.ready)
+        self.ready.clear()
+        self.elements_parsed += len(elts)
+        return elts
 
 class Command(object):
     # Values for self.state
@@ -206,8 +322,17 @@ class Command(object):
 
     next_edit = -1
 
+    # A session can hold tens of thousands of commands, so they are stored
+    # without a per instance __dict__. The edit id is stored as a plain int,
+    # and only wrapped into an EditId when it is read.
+    __slots__ = ('edit', 'state_id', 'state', 'end', 'msg_type',
+                 'msg_start_offset', 'msg_start', 'msg_stop_offset',
+                 'msg_stop', 'worker', 'index', 'text', 'normalized',
+                 'text_hash', 'kept_state', 'submitted', 'started',
+                 'finished')
+
     def __init__(self, end):
-        self.edit_id = EditId(Command.next_edit)
+        self.edit = Command.next_edit
         Command.next_edit -= 1
         self.state_id = None
         self.state = self.SENT
@@ -229,55 +354,273 @@ class Command(object):
         self.msg_stop = None
         # The worker that was last processing this command
         self.worker = None
+        # The position of this command in CoqTop.states
+        self.index = None
+        # The text of the command, as it was sent
+        self.text = None
+        # The text as normalized by sentences.normalize, and its hash
+        self.normalized = None
+        self.text_hash = None
+        # The state the command had before a rewind that kept it
+        self.kept_state = None
+        # When the Add call was sent, when coqtop started processing the
+        # command, and when it finished, as time.time() values
+        self.submitted = None
+        self.started = None
+        self.finished = None
+
+    def has_text(self, normalized):
+        "Returns True if the normalized text of the command is [normalized]"
+        # Most texts that differ already differ by their hash
+        return (self.text_hash == hash(normalized) and
+                self.normalized == normalized)
+
+    @property
+    def edit_id(self):
+        return None if self.edit is None else EditId(self.edit)
+
+    @edit_id.setter
+    def edit_id(self, edit_id):
+        self.edit = None if edit_id is None else edit_id.id
+
+    def duration(self):
+        "Returns the seconds coqtop spent processing the command, or None"
+        start = self.started if self.started is not None else self.submitted
+        if self.finished is None or start is None:
+            return None
+        return self.finished - start
+
+class LRUCache(object):
+    "A dict that forgets its least recently used entries past [size]"
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            # Move it to the most recently used end
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+class MessageLog(object):
+    """
+    The last [limit] messages from coqtop, oldest first. Each message gets a
+    sequence number, so a view can ask for the ones it has not shown yet.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = deque()
+        # The sequence number of the next message
+        self.next_seq = 0
+        # Incremented by each clear
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, message):
+        return message in self.entries
+
+    def append(self, message):
+        self.entries.append(message)
+        self.next_seq += 1
+        while len(self.entries) > max(self.limit, 1):
+            self.entries.popleft()
+
+    def clear(self):
+        self.entries.clear()
+        self.epoch += 1
+
+    def since(self, seq):
+        "Returns the kept messages whose sequence number is seq or more"
+        count = min(self.next_seq - seq, len(self.entries))
+        return [self.entries[i]
+                for i in range(len(self.entries) - count, len(self.entries))]
 
 class CoqTop(object):
     # bit fields for self.result
     COMMAND_CHANGED = 1
     MESSAGE_RECEIVED = 2
     SEND_DONE = 4
+    # The goals fetched by send_async are ready, see take_goals
+    GOALS_READY = 8
 
     def __init__(self):
+        # The program restart_coq runs, before the protocol arguments. Tests
+        # and benchmarks point this at mock_coqtop.py.
+        self.coqtop_command = ['coqtop']
+        # The CoqtopPool restart_coq takes processes from, if any
+        self.pool = None
         self.coqtop = None
         self.states = []
-        # A list of states that were reverted. These stick around until the
-        # error messages are cleared, to track where the errors are in the
-        # reverted commands. This is important because sometimes coqtop forces
-        # the state to get reverted.
-        # the states to get reverted.
-        self.messages = []
+        self.reverted_index = 0
+        # Indexes into self.states. They are kept up to date by
+        # append_command, set_state_id and truncate_commands.
+        #
+        # Maps StateId to Command
+        self.state_id_index = {}
+        # Maps the int from EditId to Command
+        self.edit_id_index = {}
+        # The end position of each command in self.states, in the same order.
+        # The active commands are sorted by position, so this can be bisected.
+        self.ends = []
+        # Changes to the commands since the last pop_events
+        self.events = []
+        # The latest messages from coqtop, in a ring buffer for the info panel
+        self.messages = MessageLog(1000)
 
         self.lock = threading.Lock()
         self.result = 0
         self.has_result = threading.Condition(self.lock)
         self.send_thread = None
+        # Set by cancel_send to stop the send thread early
+        self.send_cancelled = False
+        # The goals fetched by the send thread
+        self.async_goals = None
+        # Whether coqtop can go forward with Edit_at to a state it was rewound
+        # from. Stock coqtop drops those states, so after the first failed
+        # try, revive no longer asks. None until revive tried.
+        self.edit_forward = None
+        # Parses the output of the running coqtop process, on the reader
+        # thread
+        self.decoder = None
+        self.reader_thread = None
+        # The answers the reader thread parsed and nobody took yet. Feedback
+        # is applied to the commands by the reader thread, and only sets
+        # feedback_pending. output_closed is set once coqtop's output ends.
+        self.responses = deque()
+        self.feedback_pending = False
+        self.output_closed = False
+        self.has_response = threading.Condition(self.lock)
+        # Maps a StateId to the goals() answer for it. States never change
+        # once they are created, so entries are valid until the state is
+        # discarded.
+        self.goal_cache = LRUCache(64)
+        # Latency histograms of the calls made to the running coqtop process
+        self.stats = call_stats.CallStats()
+        # When the call in progress was sent, and the time it spent so far
+        # [waiting for output, decoding output, in feedback callbacks]. The
+        # output is decoded on the reader thread, during the wait.
+        self.call_start = 0.0
+        self.call_timing = [0.0, 0.0, 0.0]
 
     def kill_coqtop(self):
+        """
+        Stops coqtop. The send thread is stopped first: its call in progress
+        fails once coqtop exited, and it must not see the commands removed.
+        """
+        self.send_cancelled = True
         with self.lock:
-            if self.coqtop:
-                try:
-                    self.coqtop.terminate()
-                    self.coqtop.communicate()
-                except OSError:
-                    pass
+            coqtop = self.coqtop
+            reader_thread = self.reader_thread
+            send_thread = self.send_thread
+            self.send_thread = None
+        if coqtop:
+            stop_coqtop(coqtop)
+            # The reader thread stops at the end of the output
+            reader_thread.join()
+        if send_thread is not None:
+            send_thread.join()
+        with self.lock:
+            # The send thread is gone, so are its results
+            self.result = 0
+            if coqtop:
                 self.coqtop = None
-                self.states = []
+                self.reader_thread = None
+                self.truncate_commands(0)
                 self.reverted_index = 0
-                self.messages = []
+                self.messages.clear()
+        if coqtop:
+            coqtop.stdout.close()
+
+    def add_event(self, event):
+        "Queues an event for pop_events. The lock must be held."
+        if isinstance(event, CommandsRemoved):
+            # The earlier events about the removed commands no longer matter
+            self.events = [e for e in self.events if e.index < event.index]
+        self.events.append(event)
+
+    def pop_events(self):
+        "Returns the events since the last call, oldest first"
+        with self.lock:
+            events = self.events
+            self.events = []
+            return events
+
+    def set_command_state(self, comm, state):
+        "The lock must be held"
+        comm.state = state
+        self.add_event(StateChanged(comm.index, state))
+
+    def message_changed(self, comm):
+        "Records a change to the msg_* fields of comm. The lock must be held."
+        self.add_event(MessageChanged(comm.index, comm.msg_type))
+
+    def append_command(self, comm):
+        "Adds comm to the end of self.states. The lock must be held."
+        comm.index = len(self.states)
+        self.add_event(CommandAdded(comm.index))
+        self.states.append(comm)
+        self.ends.append(comm.end)
+        if comm.edit is not None:
+            self.edit_id_index[comm.edit] = comm
+        if comm.state_id is not None:
+            self.state_id_index[comm.state_id] = comm
+
+    def set_state_id(self, comm, state_id):
+        "Assigns the state id coqtop picked for comm. The lock must be held."
+        if comm.state_id is not None:
+            del self.state_id_index[comm.state_id]
+        comm.state_id = state_id
+        if state_id is not None:
+            self.state_id_index[state_id] = comm
+
+    def truncate_commands(self, idx):
+        "Removes self.states[idx:] and their indexes. The lock must be held."
+        for comm in self.states[idx:]:
+            self.goal_cache.discard(comm.state_id)
+            if self.edit_id_index.get(comm.edit) is comm:
+                del self.edit_id_index[comm.edit]
+            if self.state_id_index.get(comm.state_id) is comm:
+                del self.state_id_index[comm.state_id]
+        if idx < len(self.states):
+            self.add_event(CommandsRemoved(idx))
+        del self.states[idx:]
+        del self.ends[idx:]
 
     def get_command_by_state_id(self, state_id):
-        for s in self.states:
-            if s.state_id == state_id:
-                 return s
-        return None
+        if state_id is None:
+            # Only the command whose Add call is in flight can be missing its
+            # state id, and it is always the last active command.
+            if self.reverted_index > 0:
+                comm = self.states[self.reverted_index - 1]
+                if comm.state_id is None:
+                    return comm
+            return None
+        return self.state_id_index.get(state_id)
 
     def get_command_by_edit(self, edit_id):
-        for s in self.states:
-            if s.edit_id == edit_id:
-                 return s
-        return None
+        return self.edit_id_index.get(edit_id.id)
 
     def check_state_indexes(self):
         assert self.reverted_index <= len(self.states)
+        assert len(self.ends) == len(self.states)
 
     def get_active_command_count(self):
         with self.lock:
@@ -297,10 +640,65 @@ class CoqTop(object):
             self.check_state_indexes()
             return list(self.states[0:self.reverted_index])
 
+    def move_commands(self, index, ends):
+        """
+        Moves the active commands from [index] on to the positions in [ends],
+        after an edit that did not change their meaning.
+        """
+        with self.lock:
+            assert index + len(ends) <= self.reverted_index
+            for (i, end) in enumerate(ends, index):
+                comm = self.states[i]
+                if comm.end == end:
+                    continue
+                comm.end = end
+                self.ends[i] = end
+                # The command after this one starts at the new end. The
+                # message positions of both are relative to their start.
+                for j in (i, i + 1):
+                    if j < len(self.states):
+                        self.states[j].msg_start = None
+                        self.states[j].msg_stop = None
+                        self.add_event(StateChanged(j, self.states[j].state))
+            self.check_state_indexes()
+
     def get_commands(self):
         with self.lock:
             return list(self.states)
 
+    def get_commands_at(self, indexes):
+        "Returns the commands at indexes, in the same order"
+        with self.lock:
+            return [self.states[i] for i in indexes]
+
+    def get_slowest_commands(self, count):
+        """
+        Returns up to [count] (duration, start, comm) tuples for the active
+        commands that took the longest to process, slowest first. start is the
+        end of the previous command.
+        """
+        with self.lock:
+            self.check_state_indexes()
+            active = self.states[1:self.reverted_index]
+            timed = [(comm.duration(), i)
+                     for (i, comm) in enumerate(active, 1)
+                     if comm.duration() is not None]
+            timed.sort(key=lambda t: t[0], reverse=True)
+            return [(duration, self.states[i - 1].end, self.states[i])
+                    for (duration, i) in timed[:count]]
+
+    def count_active_commands_until(self, line, col):
+        """
+        Returns the number of active commands that end at or before the 0-based
+        (line, col) position.
+        """
+        with self.lock:
+            self.check_state_indexes()
+            # The byte offset grows with the column, so every end with a
+            # (line, col) prefix <= (line, col) sorts before this key.
+            return bisect_right(self.ends, (line, col, float('inf')), 0,
+                                self.reverted_index)
+
     def parse_feedback(self, xml):
         assert xml.tag == 'feedback'
         message = None
@@ -333,9 +731,11 @@ class CoqTop(object):
                     loc = messageNode[1].find("loc")
                     comm.msg_start_offset = int(loc.get("start"))
                     comm.msg_stop_offset = int(loc.get("stop"))
+                self.message_changed(comm)
                 # Only transition from SENT to PROCESSED.
                 if comm.state == Command.SENT:
-                    comm.state = Command.PROCESSED
+                    comm.finished = time.time()
+                    self.set_command_state(comm, Command.PROCESSED)
                 self.result |= self.COMMAND_CHANGED
             message = parse_value(messageNode.find("richpp"))
             self.messages.append(message)
@@ -344,6 +744,8 @@ class CoqTop(object):
         elif feedback_type == "processingin":
             if comm is not None:
                 comm.worker = parse_value(feedback_content[0])
+                if comm.started is None:
+                    comm.started = time.time()
         elif feedback_type == "workerstatus":
             (worker, status) = parse_value(feedback_content[0])
             if status == "Dead":
@@ -351,13 +753,14 @@ class CoqTop(object):
                 # abandoned.
                 for c in self.states[0:self.reverted_index]:
                     if c.state == Command.SENT and c.worker == worker:
-                        c.state = Command.ABANDONED
+                        self.set_command_state(c, Command.ABANDONED)
                 self.result |= self.COMMAND_CHANGED
                 self.has_result.notify()
         elif feedback_type == "processed":
             # Only transition from SENT to PROCESSED.
             if comm and comm.state == Command.SENT:
-                comm.state = Command.PROCESSED
+                comm.finished = time.time()
+                self.set_command_state(comm, Command.PROCESSED)
                 self.result |= self.COMMAND_CHANGED
                 self.has_result.notify()
         return message
@@ -374,48 +777,100 @@ class CoqTop(object):
                 # Attach the warning message to the command that is currently being
                 # parsed.
                 comm.msg_type = Command.WARNING
+                self.message_changed(comm)
         self.messages.append(parse_value(xml[2]))
 
-    def process_response(self):
-        fd = self.coqtop.stdout.fileno()
-        data = u''
-        while True:
-            try:
-                data += os.read(fd, 0x4000).decode("utf-8")
+    def process_elements(self, elts):
+        """
+        Handles top level elements from coqtop. Returns the parsed answer if
+        there was a <value>, or None if there was only feedback.
+        """
+        with self.lock:
+            valueNode = None
+            messageNode = None
+            for c in elts:
+                if c.tag == 'value':
+                    valueNode = c
+                if c.tag == 'message':
+                    self.parse_message(c)
+                # Extract messages from feedbacks to handle errors
+                if c.tag == 'feedback':
+                    messageNode = self.parse_feedback(c)
+            if valueNode is None:
+                return None
+            vp = parse_response(valueNode)
+            if messageNode is not None:
+                if isinstance(vp, Ok):
+                    return Ok(vp.val, messageNode)
+                elif isinstance(vp, Err):
+                    if vp.err not in self.messages:
+                        self.messages.append(vp.err)
+                    # Override error message : coq provides one
+                    return Err(messageNode, vp.revert_state,
+                               vp.loc_s, vp.loc_e)
+            return vp
+
+    def read_output(self, coqtop, decoder):
+        """
+        The body of the reader thread of the coqtop process [coqtop]. Applies
+        the feedback as soon as it arrives, and queues the answers for
+        process_response.
+        """
+        fd = coqtop.stdout.fileno()
+        try:
+            while True:
                 try:
-                    elt = ET.fromstring('<coqtoproot>' + escape(data) + '</coqtoproot>')
-                    with self.lock:
-                        # The data parsed correctly. Clear it so that it isn't
-                        # parsed again when new data comes in.
-                        data = ''
-                        valueNode = None
-                        messageNode = None
-                        for c in elt:
-                            if c.tag == 'value':
-                                valueNode = c
-                            if c.tag == 'message':
-                                self.parse_message(c)
-                            # Extract messages from feedbacks to handle errors
-                            if c.tag == 'feedback':
-                                messageNode = self.parse_feedback(c)
-                        if valueNode is None:
-                            return None
-                        vp = parse_response(valueNode)
-                        if messageNode is not None:
-                            if isinstance(vp, Ok):
-                                return Ok(vp.val, messageNode)
-                            elif isinstance(vp, Err):
-                                if vp.err not in self.messages:
-                                    self.messages.append(vp.err)
-                                # Override error message : coq provides one
-                                return Err(messageNode, vp.revert_state,
-                                           vp.loc_s, vp.loc_e)
-                        return vp
-                except ET.ParseError:
-                    continue
-            except OSError:
-                # coqtop died
+                    data = os.read(fd, 0x4000)
+                except OSError:
+                    data = b''
+                if not data:
+                    # coqtop died
+                    break
+                start = time.time()
+                decoder.feed(data)
+                elts = decoder.pop_elements()
+                answer = self.process_elements(elts) if elts else None
+                with self.lock:
+                    self.call_timing[1] += time.time() - start
+                    if answer is not None:
+                        self.responses.append(answer)
+                    elif elts:
+                        self.feedback_pending = True
+                    else:
+                        # Wait for the rest of the element
+                        continue
+                    self.has_response.notify_all()
+        finally:
+            with self.lock:
+                self.output_closed = True
+                self.has_response.notify_all()
+
+    def process_response(self, timeout=None):
+        """
+        Waits for the reader thread. Returns the next answer from coqtop, or
+        None if feedback was processed instead, or if timeout seconds passed
+        first.
+        """
+        start = time.time()
+        with self.lock:
+            while (not self.responses and not self.feedback_pending and
+                   not self.output_closed):
+                if timeout is None:
+                    self.has_response.wait()
+                else:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        break
+                    self.has_response.wait(remaining)
+            self.call_timing[0] += time.time() - start
+            if self.responses:
+                return self.responses.popleft()
+            if self.feedback_pending:
+                self.feedback_pending = False
+                return None
+            if self.output_closed:
                 return Err("coq died", 0, None, None)
+            return None
 
     def get_answer(self, feedback_callback):
         answer = None
@@ -426,53 +881,91 @@ class CoqTop(object):
             # The only way None could have been returned is if feedback was
             # processed instead.
             if feedback_callback is not None:
+                start = time.time()
                 feedback_callback()
+                self.call_timing[2] += time.time() - start
+
+    def begin_call(self):
+        "Starts timing a call. Must be called before the call is sent."
+        with self.lock:
+            self.call_start = time.time()
+            self.call_timing = [0.0, 0.0, 0.0]
+
+    def end_call(self, name):
+        "Records the timing of the call started by begin_call"
+        total = time.time() - self.call_start
+        with self.lock:
+            self.stats.record(name, total, *self.call_timing)
+
+    def get_stats(self):
+        "Returns the call statistics as a JSON compatible dict"
+        with self.lock:
+            return self.stats.to_json()
+
+    def get_stats_report(self):
+        with self.lock:
+            return self.stats.report()
 
     def call(self, name, arg, feedback_callback=None):
+        self.begin_call()
         xml = encode_call(name, arg)
         msg = ET.tostring(xml, 'utf-8')
         self.send_cmd(msg)
         response = self.get_answer(feedback_callback)
+        self.end_call(name)
         return response
 
     def send_cmd(self, cmd):
-        self.coqtop.stdin.write(cmd)
-        self.coqtop.stdin.flush()
+        try:
+            self.coqtop.stdin.write(cmd)
+            self.coqtop.stdin.flush()
+        except (OSError, IOError, ValueError):
+            # coqtop exited, or kill_coqtop closed its input. Waiting for the
+            # answer reports it.
+            pass
 
     def restart_coq(self, *args):
         if self.coqtop: self.kill_coqtop()
-        options = [ 'coqtop'
-                  , '-ideslave'
-                  , '-main-channel'
-                  , 'stdfds'
-                  , '-async-proofs'
-                  , 'on'
-                  ]
+        # Relative paths in args are resolved from here
+        cwd = os.getcwd()
+        # A process from the pool already answered Init
+        warm = None
+        if self.pool is not None:
+            warm = self.pool.take(self.coqtop_command, args, cwd)
         try:
             with self.lock:
-                if os.name == 'nt':
-                    self.coqtop = subprocess.Popen(
-                        options + list(args)
-                      , stdin = subprocess.PIPE
-                      , stdout = subprocess.PIPE
-                      , stderr = subprocess.STDOUT
-                    )
+                self.responses.clear()
+                self.feedback_pending = False
+                self.output_closed = False
+                self.stats = call_stats.CallStats()
+                self.goal_cache.clear()
+                self.edit_forward = None
+                if warm is not None:
+                    self.decoder = warm.decoder
+                    self.coqtop = warm.process
                 else:
-                    self.coqtop = subprocess.Popen(
-                        options + list(args)
-                      , stdin = subprocess.PIPE
-                      , stdout = subprocess.PIPE
-                      , preexec_fn = ignore_sigint
-                    )
-
-            r = self.call('Init', Option(None))
+                    self.decoder = XmlStreamDecoder()
+                    self.coqtop = spawn_coqtop(self.coqtop_command, args,
+                                               cwd)
+                self.reader_thread = threading.Thread(
+                        target=self.read_output,
+                        args=(self.coqtop, self.decoder),
+                        name="coqtop reader")
+                self.reader_thread.daemon = True
+                self.reader_thread.start()
+
+            if warm is not None:
+                r = Ok(warm.state_id, None)
+            else:
+                r = self.call('Init', Option(None))
             with self.lock:
                 assert isinstance(r, Ok)
                 comm = Command((0, 0, 0))
                 comm.edit_id = None
                 comm.state_id = r.val
                 comm.state = Command.PROCESSED
-                self.states = [comm]
+                self.truncate_commands(0)
+                self.append_command(comm)
                 self.reverted_index = len(self.states)
                 self.check_state_indexes()
                 return True
@@ -494,34 +987,60 @@ class CoqTop(object):
     def clear_messages(self):
         with self.lock:
             self.check_state_indexes()
-            self.messages = []
-            del self.states[self.reverted_index:]
+            self.messages.clear()
+            # Keep the reverted commands that revive can still use
+            idx = self.reverted_index
+            while idx < len(self.states) and self.can_revive(self.states[idx]):
+                idx += 1
+            self.truncate_commands(idx)
             self.check_state_indexes()
 
     def get_messages(self):
         with self.lock:
             return "\n".join(self.messages)
 
+    def get_new_messages(self, seq, epoch):
+        """
+        For a view that shows the messages before sequence number [seq] from
+        [epoch] of the log, returns (seq, epoch, reset, messages) to update it
+        with. If reset is True, the view must be emptied before the messages
+        are shown. Otherwise messages are only the new ones.
+        """
+        with self.lock:
+            log = self.messages
+            if epoch != log.epoch:
+                return (log.next_seq, log.epoch, True, list(log))
+            return (log.next_seq, log.epoch, False, log.since(seq))
+
     def advance(self, cmd, end):
+        comm = Command(end)
+        comm.text = cmd
+        normalized = sentences.normalize(cmd)
+        # Most sentences are already normalized. Share their text then.
+        comm.normalized = cmd if normalized == cmd else normalized
+        comm.text_hash = hash(normalized)
         with self.lock:
             cur_state = self.cur_state()
-            assert self.reverted_index == len(self.states)
-            comm = Command(end)
-            self.states.append(comm)
+            # The new state replaces the reverted ones
+            self.truncate_commands(self.reverted_index)
+            self.append_command(comm)
             self.reverted_index += 1
-        r = self.call('Add', ((cmd, comm.edit_id.id),
+            comm.submitted = time.time()
+        r = self.call('Add', ((cmd, comm.edit),
                               (cur_state, True)))
         with self.lock:
             if r is None or isinstance(r, Err):
-                comm.state = Command.ABANDONED
+                self.set_command_state(comm, Command.ABANDONED)
                 if r is not None:
                     self.messages.append(r.err)
-                    comm.msg_start_offset = int(r.loc_s)
-                    comm.msg_stop_offset = int(r.loc_e)
+                    if r.loc_s is not None:
+                        comm.msg_start_offset = int(r.loc_s)
+                        comm.msg_stop_offset = int(r.loc_e)
                     comm.msg_type = Command.ERROR
+                    self.message_changed(comm)
                 self.reverted_index -= 1
                 return r
-            comm.state_id = r.val[0]
+            self.set_state_id(comm, r.val[0])
             return r
 
     def rewind(self, step = 1, keep_states = False):
@@ -531,14 +1050,63 @@ class CoqTop(object):
             self.check_state_indexes()
             idx = self.reverted_index - step
             for c in self.states[idx:]:
-                c.state = Command.REVERTED
+                if c.state != Command.REVERTED:
+                    c.kept_state = c.state
+                    self.set_command_state(c, Command.REVERTED)
             self.reverted_index = idx
             if not keep_states:
-                del self.states[self.reverted_index:]
+                self.truncate_commands(self.reverted_index)
             self.check_state_indexes()
             rewind_state = self.cur_state()
         return self.call('Edit_at', rewind_state)
 
+    def can_revive(self, comm):
+        """
+        Returns True if comm is a reverted command that coqtop finished
+        without a message, so revive can go back to its state. The lock must
+        be held.
+        """
+        return (self.edit_forward is not False and
+                comm.state == Command.REVERTED and
+                comm.kept_state == Command.PROCESSED and
+                comm.msg_type == Command.NONE and comm.state_id is not None)
+
+    def revive(self, cmd, end):
+        """
+        If the first reverted command has the text [cmd], asks coqtop to go
+        forward to its state with Edit_at, instead of adding [cmd] again. Its
+        end moves to [end]. Returns True if coqtop went to the state. Otherwise
+        the reverted commands are discarded, and [cmd] must be added.
+        """
+        with self.lock:
+            idx = self.reverted_index
+            if idx >= len(self.states):
+                return False
+            comm = self.states[idx]
+            if (not self.can_revive(comm) or
+                    not comm.has_text(sentences.normalize(cmd))):
+                self.truncate_commands(idx)
+                return False
+        r = self.call('Edit_at', comm.state_id)
+        with self.lock:
+            if self.edit_forward is None:
+                self.edit_forward = isinstance(r, Ok)
+            if isinstance(r, Ok) and isinstance(r.val, Inl):
+                comm.end = end
+                self.ends[idx] = end
+                comm.kept_state = None
+                self.set_command_state(comm, Command.PROCESSED)
+                self.reverted_index += 1
+                self.check_state_indexes()
+                return True
+            self.truncate_commands(idx)
+            cur_state = self.cur_state()
+        if isinstance(r, Ok):
+            # coqtop focused a proof instead. Go back to where the next Add
+            # expects it.
+            self.call('Edit_at', cur_state)
+        return False
+
     def query(self, cmd):
         with self.lock:
             cur_state = self.cur_state()
@@ -550,8 +1118,15 @@ class CoqTop(object):
             return any(c.state == Command.SENT for c in self.states[0:self.reverted_index])
 
     def goals(self, feedback_callback):
+        with self.lock:
+            state_id = self.cur_state()
+            cached = self.goal_cache.get(state_id)
+        if cached is not None:
+            return cached
         vp = self.call('Goal', (), feedback_callback=feedback_callback)
         if isinstance(vp, Ok):
+            with self.lock:
+                self.goal_cache.put(state_id, vp.val)
             return vp.val
         with self.lock:
             if vp.revert_state.id == 0:
@@ -573,22 +1148,62 @@ class CoqTop(object):
         self.rewind(self.reverted_index - revert_to, keep_states = True)
         vp = self.call('Goal', (), feedback_callback=feedback_callback)
         if isinstance(vp, Ok):
+            with self.lock:
+                self.goal_cache.put(self.cur_state(), vp.val)
             return vp.val
         else:
-            if vp.err not in self.messages:
-                self.messages.append(vp.err)
+            with self.lock:
+                if vp.err not in self.messages:
+                    self.messages.append(vp.err)
             return None
 
-    def send_async(self, send_queue):
+    def send_async(self, send_queue, fetch_goals=False, goals_each=False):
         """
         Tries to send every message in [send_queue] to Coq, stops at the first
         error.
+
+        If [fetch_goals] is set, the thread then fetches the goals for
+        take_goals, and keeps reading feedback until every command is checked,
+        so the caller does not have to talk to coqtop while it is busy.
+
+        If [goals_each] is set, the goals of every new state are fetched into
+        the goal cache, see get_cached_goals.
         """
         assert self.send_thread == None
+        self.send_cancelled = False
+        def goals_reverted():
+            """
+            Fetches the goals of the current state. Returns True if coqtop
+            found an error on the way, so goals went back to an earlier state.
+            """
+            with self.lock:
+                state_id = self.cur_state()
+            self.goals(None)
+            with self.lock:
+                if self.cur_state() == state_id:
+                    return False
+                self.result |= self.COMMAND_CHANGED | self.MESSAGE_RECEIVED
+                self.has_result.notify()
+                return True
         def process_queue():
             try:
-                for (message, end) in send_queue:
-                    response = self.advance(message, end)
+                queue = iter(send_queue)
+                item = next(queue, None)
+                # Go forward through the reverted states that match the queue
+                while (item is not None and not self.send_cancelled and
+                       self.revive(*item)):
+                    with self.lock:
+                        self.result |= self.COMMAND_CHANGED
+                        self.has_result.notify()
+                    if (goals_each and not self.send_cancelled and
+                            goals_reverted()):
+                        # The rest of the queue would go after the error
+                        item = None
+                        break
+                    item = next(queue, None)
+                while item is not None and not self.send_cancelled:
+                    response = self.advance(*item)
+                    item = next(queue, None)
                     with self.lock:
                         self.result |= self.COMMAND_CHANGED
                         self.has_result.notify()
@@ -607,6 +1222,11 @@ class CoqTop(object):
                                 self.result |= self.MESSAGE_RECEIVED
                                 self.has_result.notify()
                             break
+                    if (goals_each and not self.send_cancelled and
+                            goals_reverted()):
+                        break
+                if fetch_goals and not self.send_cancelled:
+                    self.fetch_goals()
             finally:
                 with self.lock:
                     self.result |= self.SEND_DONE
@@ -615,10 +1235,57 @@ class CoqTop(object):
         self.send_thread = threading.Thread(target=process_queue, name="send thread")
         self.send_thread.start()
 
-    def wait_for_result(self):
+    def fetch_goals(self):
+        "Does the work of refresh on the send thread"
+        goals = self.goals(None)
+        with self.lock:
+            self.async_goals = goals
+            self.result |= self.GOALS_READY | self.MESSAGE_RECEIVED
+            self.has_result.notify()
+        while not self.send_cancelled and self.has_unchecked_commands():
+            if self.process_response(0.1) is not None:
+                # coqtop died, or sent an answer nobody asked for
+                break
+
+    def get_cached_goals(self, state_id):
+        "Returns the goals() answer for state_id if it is cached, or None"
+        with self.lock:
+            return self.goal_cache.get(state_id)
+
+    def take_goals(self):
+        "Returns the goals fetched by the send thread"
+        with self.lock:
+            goals = self.async_goals
+            self.async_goals = None
+            return goals
+
+    def cancel_send(self):
+        """
+        Asks the send thread to stop after the call in progress. finish_send
+        must still be called.
+        """
+        self.send_cancelled = True
+
+    def is_sending(self):
         with self.lock:
+            return self.send_thread is not None
+
+    def wait_for_result(self, timeout=None):
+        """
+        Returns the result bits set since the last call, waiting for at least
+        one. Returns 0 if timeout seconds pass first.
+        """
+        with self.lock:
+            if timeout is not None:
+                deadline = time.time() + timeout
             while self.result == 0:
-                self.has_result.wait()
+                if timeout is None:
+                    self.has_result.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return 0
+                    self.has_result.wait(remaining)
             result = self.result
             self.result = 0
             return result
@@ -627,4 +1294,6 @@ class CoqTop(object):
         with self.lock:
             thread = self.send_thread
             self.send_thread = None
-        thread.join()
+        # kill_coqtop already joined it
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,205 @@
+# Keeps coqtop processes spawned and initialized ahead of time, so launching
+# coqtop does not have to wait for it to load its load path.
+#
+# The processes are grouped by the command line and the directory they were
+# started with, since relative load paths are resolved from that directory.
+# Each process handed out by take is replaced in the background.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import coqtop as CT
+
+def process_memory(process):
+    """
+    Returns the resident memory of the process in bytes, or 0 where it cannot
+    be measured.
+    """
+    try:
+        with open('/proc/%d/statm' % process.pid) as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+def init_coqtop(process, decoder):
+    """
+    Sends Init to a new coqtop process and waits for the answer. Returns the
+    root state id, or None if coqtop failed. The feedback read before the
+    answer is dropped, and any output after it stays in the decoder.
+    """
+    xml = CT.encode_call('Init', CT.Option(None))
+    process.stdin.write(ET.tostring(xml, 'utf-8'))
+    process.stdin.flush()
+    fd = process.stdout.fileno()
+    while True:
+        data = os.read(fd, 0x4000)
+        if not data:
+            return None
+        decoder.feed(data)
+        elts = decoder.pop_elements()
+        for (i, elt) in enumerate(elts):
+            if elt.tag == 'value':
+                # Leave the elements after the answer for the reader thread
+                decoder.ready.extend(elts[i + 1:])
+                r = CT.parse_response(elt)
+                return r.val if isinstance(r, CT.Ok) else None
+
+class WarmCoqtop(object):
+    "A coqtop process that already answered Init"
+    def __init__(self, process, decoder, state_id):
+        self.process = process
+        # Holds the output read after the Init answer
+        self.decoder = decoder
+        self.state_id = state_id
+        self.created = time.time()
+
+class CoqtopPool(object):
+    def __init__(self, size, idle_timeout=0, max_memory=0,
+                 spawn=CT.spawn_coqtop):
+        # The number of idle processes to keep for each command line
+        self.size = size
+        # Idle processes older than this many seconds are stopped. 0 keeps
+        # them forever.
+        self.idle_timeout = idle_timeout
+        # No process is started while the idle processes use this many bytes
+        # or more. 0 is no limit.
+        self.max_memory = max_memory
+        self.spawn = spawn
+        self.lock = threading.Lock()
+        # Maps a (cwd,) + command line tuple to its idle WarmCoqtops, oldest
+        # first
+        self.idle = {}
+        # Maps a (cwd,) + command line tuple to the number of processes
+        # starting
+        self.starting = {}
+        self.closed = False
+
+    def take(self, command, args, cwd):
+        """
+        Returns a WarmCoqtop started as [command] with [args] in the directory
+        [cwd], or None if none is ready. Either way, the pool is refilled in
+        the background.
+        """
+        key = (cwd,) + tuple(command) + tuple(args)
+        with self.lock:
+            idle = self.idle.get(key)
+            warm = idle.pop(0) if idle else None
+        if warm is not None and warm.process.poll() is not None:
+            # It exited while it was idle
+            warm = None
+        self.refill(command, args, cwd)
+        return warm
+
+    def refill(self, command, args, cwd):
+        """
+        Starts enough processes to have size idle ones for the command line
+        and directory
+        """
+        key = (cwd,) + tuple(command) + tuple(args)
+        if self.max_memory > 0 and self.memory() >= self.max_memory:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            missing = (self.size - len(self.idle.get(key, [])) -
+                       self.starting.get(key, 0))
+            if missing <= 0:
+                return
+            self.starting[key] = self.starting.get(key, 0) + missing
+        for i in range(missing):
+            thread = threading.Thread(target=self.warm_up,
+                                      args=(key, command, args, cwd),
+                                      name="coqtop pool")
+            thread.daemon = True
+            thread.start()
+
+    def warm_up(self, key, command, args, cwd):
+        "Starts a process for the pool. Runs on its own thread."
+        warm = None
+        try:
+            process = self.spawn(command, args, cwd)
+            decoder = CT.XmlStreamDecoder()
+            try:
+                state_id = init_coqtop(process, decoder)
+            except (OSError, IOError):
+                state_id = None
+            if state_id is not None:
+                warm = WarmCoqtop(process, decoder, state_id)
+            else:
+                CT.stop_coqtop(process)
+        except OSError:
+            # coqtop could not be started. restart_coq reports it.
+            pass
+        with self.lock:
+            self.starting[key] -= 1
+            if warm is not None and not self.closed:
+                self.idle.setdefault(key, []).append(warm)
+                warm = None
+        if warm is not None:
+            # The pool was closed meanwhile
+            self.stop(warm)
+            return
+        if self.idle_timeout > 0:
+            timer = threading.Timer(self.idle_timeout, self.expire)
+            timer.daemon = True
+            timer.start()
+        self.trim()
+
+    def memory(self):
+        "Returns the resident memory of the idle processes in bytes"
+        with self.lock:
+            processes = [w.process for idle in self.idle.values()
+                         for w in idle]
+        return sum(process_memory(p) for p in processes)
+
+    def remove(self, predicate):
+        "Stops the idle processes predicate(warm) is true for"
+        removed = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                removed.extend(w for w in idle if predicate(w))
+                idle[:] = [w for w in idle if not predicate(w)]
+        for warm in removed:
+            self.stop(warm)
+
+    def expire(self):
+        "Stops the processes that were idle for longer than idle_timeout"
+        if self.idle_timeout > 0:
+            deadline = time.time() - self.idle_timeout
+            self.remove(lambda w: w.created <= deadline)
+
+    def trim(self):
+        "Stops the oldest idle processes until they fit in max_memory"
+        if self.max_memory <= 0:
+            return
+        with self.lock:
+            idle = sorted((w for ws in self.idle.values() for w in ws),
+                          key=lambda w: w.created)
+        used = sum(process_memory(w.process) for w in idle)
+        stopped = set()
+        while idle and used > self.max_memory:
+            warm = idle.pop(0)
+            used -= process_memory(warm.process)
+            stopped.add(id(warm))
+        if stopped:
+            self.remove(lambda w: id(w) in stopped)
+
+    def close(self):
+        """
+        Stops every idle process. The processes still starting are stopped
+        once they are ready.
+        """
+        with self.lock:
+            self.closed = True
+        self.remove(lambda w: True)
+
+    def stop(self, warm):
+        CT.stop_coqtop(warm.process)
+        warm.process.stdout.close()
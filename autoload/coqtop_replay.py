@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Replays a trace recorded by coqtop-log.py against coqtop.CoqTop, without
+# running coqtop.
+#
+# The replay has two halves:
+#
+# - This script, started with --serve, stands in for coqtop. It answers the
+#   n-th call it receives with the documents coqtop sent after the n-th
+#   recorded call, with the recorded delays.
+# - [replay] drives a CoqTop connected to that stand in, issuing the recorded
+#   calls through the same CoqTop methods coquille uses, with the recorded
+#   pauses between them.
+#
+# All the delays are multiplied by the scale factor. A scale of 0 replays as
+# fast as possible, which is what performance regression tests want.
+#
+#   python coqtop_replay.py [--scale 0.5] coq-xml-log-1234.jsonl
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+from collections import namedtuple
+
+import coqtop as CT
+
+Event = namedtuple('Event', ['time', 'stream', 'data'])
+
+# One recorded call and the documents coqtop sent back before the next call.
+# The output events are relative to the time of the call.
+Exchange = namedtuple('Exchange', ['time', 'call', 'outputs'])
+
+def load_trace(path):
+    "Returns the events of a trace written by coqtop-log.py"
+    events = []
+    with io.open(path, encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != 1:
+            raise ValueError("%s: unsupported trace version %r" %
+                             (path, header.get("version")))
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                events.append(Event(entry["time"], entry["stream"],
+                                    entry["data"]))
+    return events
+
+def split_exchanges(events):
+    """
+    Groups the events into exchanges. Output sent before the first call is
+    attached to a first exchange with a call of None.
+    """
+    exchanges = []
+    current = Exchange(0.0, None, [])
+    for e in events:
+        if e.stream == "input":
+            if current.call is not None or current.outputs:
+                exchanges.append(current)
+            current = Exchange(e.time, e.data, [])
+        else:
+            current.outputs.append(Event(e.time - current.time, e.stream,
+                                         e.data))
+    if current.call is not None or current.outputs:
+        exchanges.append(current)
+    return exchanges
+
+def parse_call(data):
+    "Returns the (name, arg) of a recorded call"
+    decoder = CT.XmlStreamDecoder()
+    decoder.feed(data.encode("utf-8"))
+    (xml,) = decoder.pop_elements()
+    return (xml.get('val'), CT.parse_value(xml[0]))
+
+def sleep_until(deadline):
+    delay = deadline - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+def serve(path, scale):
+    "Stands in for coqtop on stdin/stdout"
+    exchanges = split_exchanges(load_trace(path))
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    if exchanges and exchanges[0].call is None:
+        for e in exchanges.pop(0).outputs:
+            out.write(e.data.encode("utf-8"))
+        out.flush()
+    decoder = CT.XmlStreamDecoder()
+    fd = sys.stdin.fileno()
+    received = 0
+    while True:
+        data = os.read(fd, 0x4000)
+        if not data:
+            break
+        decoder.feed(data)
+        for call in decoder.pop_elements():
+            arrival = time.time()
+            if received >= len(exchanges):
+                print("coqtop_replay: unexpected call %s after the end of "
+                      "the trace" % call.get('val'), file=sys.stderr)
+                return
+            exchange = exchanges[received]
+            received += 1
+            expected = parse_call(exchange.call)[0]
+            if call.get('val') != expected:
+                print("coqtop_replay: call %d is %s, but %s was recorded" %
+                      (received, call.get('val'), expected), file=sys.stderr)
+            for e in exchange.outputs:
+                sleep_until(arrival + e.time * scale)
+                out.write(e.data.encode("utf-8"))
+                out.flush()
+
+def value_time(exchange):
+    "Returns when the answer to the call of exchange arrived"
+    for e in exchange.outputs:
+        if e.data.lstrip().startswith("<value"):
+            return exchange.time + e.time
+    return exchange.time
+
+def replay(path, scale=0.0, coqtop_args=()):
+    """
+    Replays the trace at path against a new CoqTop. Returns a dict mapping
+    each call name to a list of its durations in seconds.
+    """
+    exchanges = [x for x in split_exchanges(load_trace(path))
+                 if x.call is not None]
+    ct = CT.CoqTop()
+    ct.coqtop_command = [sys.executable, os.path.abspath(__file__),
+                         "--serve", "--scale", repr(scale), path]
+    timings = {}
+    start = time.time()
+    if not ct.restart_coq(*coqtop_args):
+        raise RuntimeError("coqtop_replay: could not start the replay server")
+    timings["Init"] = [time.time() - start]
+    prev_answer = value_time(exchanges[0])
+    replay_start = time.time() - prev_answer * scale
+    line = 0
+    for exchange in exchanges[1:]:
+        (name, arg) = parse_call(exchange.call)
+        # Wait as long as the user did between the previous answer and this
+        # call.
+        sleep_until(replay_start + exchange.time * scale)
+        call_start = time.time()
+        if name == 'Add':
+            ((cmd, edit), (parent, verbose)) = arg
+            line += 1
+            ct.advance(cmd, (line, 0, 0))
+        elif name == 'Edit_at':
+            active = [c.state_id for c in ct.get_active_commands()]
+            if arg in active[:-1]:
+                ct.rewind(len(active) - 1 - active.index(arg))
+            else:
+                ct.call(name, arg)
+        else:
+            ct.call(name, arg)
+        timings.setdefault(name, []).append(time.time() - call_start)
+        # Keep following the recorded timeline, even if this replay ran
+        # faster or slower.
+        replay_start = time.time() - value_time(exchange) * scale
+    ct.kill_coqtop()
+    return timings
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=0.0,
+                        help="Multiplies all the recorded delays")
+    parser.add_argument("--serve", action="store_true",
+                        help="Stand in for coqtop (used internally)")
+    parser.add_argument("trace")
+    args, coqtop_args = parser.parse_known_args(argv)
+    if args.serve:
+        serve(args.trace, args.scale)
+        return
+    start = time.time()
+    timings = replay(args.trace, args.scale)
+    elapsed = time.time() - start
+    print("Replayed %s in %.3f s" % (args.trace, elapsed))
+    for name in sorted(timings):
+        durations = timings[name]
+        print("  %-10s %6d calls, %8.3f ms total, %8.3f ms max" %
+              (name, len(durations), sum(durations) * 1000,
+               max(durations) * 1000))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,10 +4,17 @@ from __future__ import division
 
 import vim
 
+import json
 import re
 import xml.etree.ElementTree as ET
 import coqtop as CT
+import coqtop_pool
+import command_colors
+import line_diff
 import project_file
+import redraw_scheduler
+import sentences
+import session_manager
 
 from collections import deque
 
@@ -44,10 +51,53 @@ def vim_repr(value):
         return value.replace("'", "''")
     return "unknown"
 
-# Convert 0-based (line, col, byte) tuples into 1-based lists in the form
-# [line, byte]
-def make_vim_range(start, stop):
-    return [[start[0] + 1, start[2] + 1], [stop[0] + 1, stop[2] + 1]]
+# Matches the normalized sentences that end a proof
+proof_end = re.compile(r'(Qed|Defined|Admitted|Abort)\b')
+
+# The CoqtopPool shared by every buffer, see get_coqtop_pool
+coqtop_pool_instance = None
+
+def get_coqtop_pool():
+    """
+    Returns the pool of pre-started coqtop processes, or None if
+    g:coquille_pool_size is 0.
+    """
+    global coqtop_pool_instance
+    if coqtop_pool_instance is None:
+        size = int(vim.vars.get('coquille_pool_size', 0))
+        if size <= 0:
+            return None
+        coqtop_pool_instance = coqtop_pool.CoqtopPool(
+                size,
+                idle_timeout=float(
+                    vim.vars.get('coquille_pool_idle_timeout', 600)),
+                max_memory=int(
+                    vim.vars.get('coquille_pool_max_memory', 0)) << 20)
+    return coqtop_pool_instance
+
+# The SessionManager shared by every buffer, see get_session_manager
+session_manager_instance = None
+
+def get_session_manager():
+    """
+    Returns the SessionManager that limits the running coqtop processes, or
+    None if neither g:coquille_max_sessions nor g:coquille_max_session_memory
+    is set.
+    """
+    global session_manager_instance
+    if session_manager_instance is None:
+        max_sessions = int(vim.vars.get('coquille_max_sessions', 0))
+        max_memory = int(vim.vars.get('coquille_max_session_memory', 0))
+        if max_sessions <= 0 and max_memory <= 0:
+            return None
+        session_manager_instance = session_manager.SessionManager(
+                max_sessions, max_memory << 20)
+    return session_manager_instance
+
+# Convert (group, range) pairs from command_colors into vim lists
+def make_vim_colors(pairs):
+    return [[group, [list(start), list(stop)]] for (group, (start, stop))
+            in pairs]
 
 # Return a list of all windows that are displaying the buffer, along with their
 # current cursor positions.
@@ -91,13 +141,62 @@ class BufferState(object):
             del cls.source_mapping[bufid]
             return None
 
+    @classmethod
+    def poll_bufid(cls, bufid):
+        "Called by the poll timer of bufid, see BufferState.poll"
+        state = cls.lookup_bufid(bufid)
+        return state is not None and state.poll()
+
     def __init__(self, source_buffer):
         self.source_buffer = source_buffer
         self.info_buffer = None
+        # What update_info last showed in the info buffer: the sequence number
+        # and epoch of the message log, the number of messages and lines, and
+        # the buffer number
+        self.info_seq = 0
+        self.info_epoch = None
+        self.info_count = 0
+        self.info_lines = 0
+        self.info_bufnr = None
         self.goal_buffer = None
+        # The lines last written to the goal buffer, and its number
+        self.goal_lines = None
+        self.goal_lines_bufnr = None
         #: See vimbufsync ( https://github.com/def-lkb/vimbufsync )
         self.saved_sync = None
         self.coq_top = CT.CoqTop()
+        self.coq_top.messages.limit = int(
+                vim.vars.get('coquille_max_messages', 1000))
+        self.coq_top.pool = get_coqtop_pool()
+        # Cached sentence boundaries of the source buffer, valid as of
+        # b:changedtick == self.sentence_tick
+        self.sentence_index = sentences.SentenceIndex(source_buffer)
+        self.sentence_tick = None
+        # The ranges colored in the source buffer
+        self.colors = command_colors.CommandColors(
+                self.convert_offset,
+                float(vim.vars.get('coquille_slow_threshold', 0)))
+        vim.command("call coquille#ClearBufferColors(%d)" %
+                    source_buffer.number)
+        # While commands are checked in the background: the end of the last
+        # queued command, and the RedrawScheduler for the poll timer
+        self.async_end = None
+        self.async_scheduler = None
+        # What poll runs once a cancelled send thread stopped: sync or
+        # continuous_check, or None
+        self.deferred = None
+        # The number of commands to check again in continuous mode: the most
+        # that were active since the user last went back explicitly
+        self.high_water = 0
+        # While commands are checked ahead of the user (g:coquille_lookahead):
+        # the number of active commands the user stepped through. None
+        # otherwise.
+        self.visible = None
+        # The arguments coqtop was last launched with
+        self.launch_args = []
+        # While the SessionManager has suspended this buffer: the (text, end)
+        # of the commands to send again when it is used
+        self.suspended = None
 
     def sync_vars(self):
         "Updates python member variables based on the vim variables"
@@ -123,19 +222,103 @@ class BufferState(object):
 
     def sync(self):
         curr_sync = vimbufsync.sync(self.source_buffer)
+        # Every branch below invalidates the sentence index from the change
+        self.sentence_tick = self._changedtick()
         if not self.saved_sync or curr_sync.buf() != self.saved_sync.buf():
-            if self.coq_top.get_active_command_count() > 1:
+            self.sentence_index.invalidate(0)
+            if self.suspended is not None:
+                self.suspended = []
+            elif self.coq_top.get_active_command_count() > 1:
                 self._reset()
+        elif self.suspended is not None:
+            (line, col) = self.saved_sync.pos()
+            self.sentence_index.invalidate(line - 1)
+            # Only replay the commands before the change
+            self.suspended = [(text, end) for (text, end) in self.suspended
+                              if (end[0], end[1]) <= (line - 1, col - 1)]
         else:
             (line, col) = self.saved_sync.pos()
             # vim indexes from lines 1, coquille from 0
-            self.rewind_to(line - 1, col - 1)
+            self.sentence_index.invalidate(line - 1)
+            if (self.async_end is not None and
+                    (line - 1, col - 1) < self.async_end[:2]):
+                # The text of a queued command changed
+                self.cancel_async()
+            if self.coq_top.is_sending() and self.coq_top.send_cancelled:
+                # coqtop is still busy with the call in progress. Leave
+                # saved_sync alone, so poll sees the change once the send
+                # thread stopped.
+                if self.deferred is None:
+                    self.deferred = self.sync
+                return
+            last = self.coq_top.get_last_active_command()
+            if (self.visible is not None and last is not None and
+                    (line - 1, col - 1) < last.end[:2]):
+                # The change could be in the commands checked ahead
+                self.drop_lookahead()
+            self.sync_commands(line - 1, col - 1)
         self.saved_sync = curr_sync
 
+    def sync_commands(self, line, col):
+        """
+        Called when the buffer changed from the 0-based (line, col) position
+        on. The sent commands after that position are compared with the
+        sentences now in the buffer. Coquille rewinds to the first one whose
+        meaning changed, and the ones before it are moved to where their
+        sentences are now. Changes to blanks and comments keep the commands,
+        except the ones with a message, which are only kept if their text did
+        not change at all.
+        """
+        if self.coq_top.coqtop is None:
+            self.rewind_to(line, col)
+            return
+        first = self.coq_top.count_active_commands_until(line, col)
+        comms = self.coq_top.get_active_commands()
+        if first >= len(comms):
+            # The change is after the sent commands
+            return
+        prev_end = comms[first - 1].end
+        ends = []
+        for comm in comms[first:]:
+            r = self._get_message_range(prev_end)
+            if r is None:
+                break
+            if comm.msg_type != CT.Command.NONE:
+                # The message location is relative to the start of the
+                # command, so it only still points to the right text if the
+                # text is the same
+                if r[0] != comm.text:
+                    break
+            elif not comm.has_text(sentences.normalize(r[0])):
+                break
+            prev_end = r[1]
+            ends.append(prev_end)
+        kept = first + len(ends)
+        if kept < len(comms):
+            self.coq_rewind(len(comms) - kept)
+        if ends and self.coq_top.get_active_command_count() >= kept:
+            self.coq_top.move_commands(first, ends)
+            self.update_colors()
+
+    def text_changed(self):
+        """
+        Called when the source buffer changed. Changes made in normal mode do
+        not move the cursor in insert mode, so they are synced here while
+        commands are sent in the background, to cancel the queue.
+        """
+        if self.coq_top.is_sending():
+            self.sync()
+
     def _reset(self):
+        self.cancel_async()
+        self.deferred = None
+        # This also stops the send thread, without waiting for coqtop
         self.coq_top.kill_coqtop()
+        self.high_water = 0
+        self.visible = None
         self.saved_sync = None
-        self.reset_color()
+        self.suspended = None
+        self.update_colors()
 
     #####################
     # exported commands #
@@ -145,13 +328,59 @@ class BufferState(object):
         if self is None:
             return
         self._reset()
+        manager = get_session_manager()
+        if manager is not None:
+            manager.forget(self)
+
+    def activate(self):
+        """
+        Called when the buffer is shown in the active window. Resumes it if it
+        was suspended, and marks it as the most recently used session.
+        """
+        if self.suspended is not None:
+            self.resume()
+        manager = get_session_manager()
+        if manager is not None and self.coq_top.coqtop is not None:
+            manager.touch(self)
+
+    def suspend(self):
+        """
+        Stops coqtop to save memory, but remembers the commands that were
+        sent, so resume can send them again.
+        """
+        if self.coq_top.coqtop is None or self.coq_top.is_sending():
+            return
+        comms = self.coq_top.get_active_commands()
+        sent = []
+        for (prev, comm) in zip(comms, comms[1:]):
+            (line, col, byte) = comm.end
+            sent.append((self._between(prev.end, (line, col - 1, byte - 1)),
+                         comm.end))
+        self.finish_async()
+        self.coq_top.kill_coqtop()
+        self.suspended = sent
+        self.update_colors()
+
+    def resume(self):
+        "Launches coqtop again, and sends the commands from before suspend"
+        sent = self.suspended
+        self.suspended = None
+        if not self.coq_top.restart_coq(*self.launch_args):
+            return
+        if sent:
+            self.send_until_fail(deque(sent))
+        else:
+            self.refresh()
 
     def goto_last_sent_dot(self):
         last = self.coq_top.get_last_active_command()
+        if self.visible is not None:
+            last = self.coq_top.get_commands_at([self.visible - 1])[0]
         (line, col) = ((0,1) if not last else last.end)
         vim.current.window.cursor = (line + 1, col)
 
     def coq_rewind(self, steps=1):
+        self.finish_async()
         self.clear_info()
 
         # Do not allow the root state to be rewound
@@ -162,7 +391,9 @@ class BufferState(object):
             print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
             return
 
-        response = self.coq_top.rewind(steps)
+        # Keep the reverted states, in case the same commands are sent again
+        keep = self.coq_top.edit_forward is not False
+        response = self.coq_top.rewind(steps, keep_states=keep)
 
         if response is None:
             vim.command("call coquille#KillSession()")
@@ -177,11 +408,17 @@ class BufferState(object):
         if (steps == 1 and vim.eval('g:coquille_auto_move') == 'true'):
             self.goto_last_sent_dot()
 
+    def coq_undo(self):
+        self.drop_lookahead()
+        self.coq_rewind()
+        self.high_water = self.coq_top.get_active_command_count()
+
     def coq_to_cursor(self):
         if self.coq_top.coqtop is None:
             print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
             return
 
+        self.drop_lookahead()
         self.sync()
 
         (cline, ccol) = vim.current.window.cursor
@@ -194,6 +431,7 @@ class BufferState(object):
             # Add 1 to the column to leave whatever is at the
             # cursor as sent.
             self.rewind_to(cline, ccol + 1)
+            self.high_water = self.coq_top.get_active_command_count()
         else:
             send_queue = deque([])
             while True:
@@ -212,6 +450,12 @@ class BufferState(object):
             print("Error: Coqtop isn't running. Are you sure you called :CoqLaunch?")
             return
 
+        if self.lookahead_next():
+            if vim.eval('g:coquille_auto_move') == 'true':
+                self.goto_last_sent_dot()
+            return
+
+        self.drop_lookahead()
         self.sync()
 
         last = self.coq_top.get_last_active_command()
@@ -225,10 +469,13 @@ class BufferState(object):
 
         self.send_until_fail(send_queue)
 
-        if (vim.eval('g:coquille_auto_move') == 'true'):
+        if (not self.coq_top.is_sending() and
+                vim.eval('g:coquille_auto_move') == 'true'):
             self.goto_last_sent_dot()
+        self.start_lookahead()
 
     def coq_raw_query(self, *args):
+        self.drop_lookahead()
         self.clear_info()
 
         if self.coq_top.coqtop is None:
@@ -244,10 +491,55 @@ class BufferState(object):
             print('ERROR: the Coq process died')
             return
 
-        info_msg = self.coq_top.get_messages()
-        self.show_info(info_msg)
+        self.update_info()
 
 
+    def show_stats(self, *args):
+        "Shows the coqtop call latencies, or saves them as JSON to args[0]"
+        if args:
+            with open(args[0], "w") as f:
+                json.dump(self.coq_top.get_stats(), f, indent=2,
+                          sort_keys=True)
+            print("Wrote the coqtop call statistics to %s" % args[0])
+        else:
+            self.show_info("Call latencies (ms)\n" +
+                           self.coq_top.get_stats_report())
+
+    def show_profile(self, count=20):
+        """
+        Lists the [count] sentences that coqtop took the longest to process in
+        the location list of the current window.
+        """
+        items = []
+        for (duration, start, comm) in self.coq_top.get_slowest_commands(
+                int(count)):
+            (line, col, byte) = comm.end
+            text = self._between(start, (line, col - 1, byte - 1))
+            # Point at the first character of the sentence
+            blanks = len(text) - len(text.lstrip())
+            (line, byte) = (start[0], start[2])
+            newline = text.rfind('\n', 0, blanks)
+            if newline != -1:
+                line += text.count('\n', 0, blanks)
+                byte = 0
+            byte += len(text[newline + 1:blanks].encode('utf-8'))
+            label = sentences.normalize(text)
+            if len(label) > 60:
+                label = label[:57] + '...'
+            items.append({
+                'bufnr': self.source_buffer.number,
+                'lnum': line + 1,
+                'col': byte + 1,
+                'text': '%8.3f s  %s%s' % (
+                    duration, label,
+                    '  [%s]' % comm.worker if comm.worker else '')})
+        if not items:
+            print("No sentence was checked yet")
+            return
+        self.source_buffer.vars['coquille_profile'] = items
+        vim.command("call coquille#ShowProfile(%d)" %
+                    self.source_buffer.number)
+
     def launch_coq(self, *args):
         use_project_args = self.source_buffer.vars.get(
                 "coquille_append_project_args",
@@ -257,6 +549,11 @@ class BufferState(object):
             args = list(args)
             args.extend(project_file.find_and_parse_file(
                 self.source_buffer.name))
+        self.finish_async()
+        self.suspended = None
+        self.high_water = 0
+        self.visible = None
+        self.launch_args = list(args)
         return self.coq_top.restart_coq(*args)
 
     def debug(self):
@@ -271,82 +568,121 @@ class BufferState(object):
     #####################################
 
     def refresh(self):
-        last_info = [None]
+        scheduler = self.new_redraw_scheduler()
         def update():
-            self.reset_color()
+            self.update_colors()
             vim.command('redraw')
-            new_info = self.coq_top.get_messages()
-            if last_info[0] != new_info:
-                self.show_info(new_info)
-                last_info[0] = new_info
+            self.update_info()
+        def feedback_received():
+            scheduler.add(CT.CoqTop.COMMAND_CHANGED)
+            if scheduler.due():
+                scheduler.take()
+                update()
         # It seems that coqtop needs some kind of call like Status or Goal to
         # trigger it to start processing all the commands that have been added.
         # So show_goal needs to be called before waiting for all the unchecked
         # commands finished.
-        response = self.coq_top.goals(update)
+        response = self.coq_top.goals(feedback_received)
         if self.show_goal(response):
             while self.coq_top.has_unchecked_commands():
-                self.coq_top.process_response()
-                update()
+                if self.coq_top.process_response() is not None:
+                    # coqtop died
+                    break
+                feedback_received()
         update()
 
+    def new_redraw_scheduler(self):
+        return redraw_scheduler.RedrawScheduler(
+                float(vim.vars.get('coquille_max_fps', 30)))
+
+    def flush_ui(self, result):
+        "Handles the CoqTop result bits merged by a RedrawScheduler"
+        if result & CT.CoqTop.GOALS_READY:
+            self.show_goal(self.coq_top.take_goals())
+        if result & CT.CoqTop.COMMAND_CHANGED:
+            self.update_colors()
+        if result & CT.CoqTop.MESSAGE_RECEIVED:
+            self.update_info()
+        if result:
+            vim.command('redraw')
+
+    def render_goals(self, response):
+        "Returns the lines to show in the goal buffer for a goals() response"
+        if response is None:
+            return ['']
+
+        goals = response.val
+        if goals is None:
+            return ['No goals.']
+
+        sub_goals = goals.fg
+        msg_format = '{0} subgoal{1}'
+        show_hyps = True
+        if not sub_goals:
+            show_hyps = False
+            sub_goals = []
+            for (before, after) in goals.bg:
+                sub_goals.extend(reversed(before))
+                sub_goals.extend(after)
+            if sub_goals:
+                msg_format = ('This subproof is complete, but there {2} {0}'
+                              ' unfocused goal{1}')
+        if not sub_goals:
+            msg_format = 'No more subgoals.'
+
+        nb_subgoals = len(sub_goals)
+        lines = [msg_format.format(nb_subgoals,
+                                   '' if nb_subgoals == 1 else 's',
+                                   'is' if nb_subgoals == 1 else 'are'),
+                 '']
+
+        for idx, sub_goal in enumerate(sub_goals):
+            _id = sub_goal.id
+            hyps = sub_goal.hyp
+            ccl = sub_goal.ccl
+            if show_hyps:
+                # we print the environment only for the current subgoal
+                for hyp in hyps:
+                    lines.extend(hyp.split('\n'))
+                show_hyps = False
+            lines.append('')
+            lines.append('======================== ( %d / %d )' % (idx+1 , nb_subgoals))
+            lines.extend(ccl.split('\n'))
+            lines.append('')
+        return lines
+
     def show_goal(self, response):
+        lines = self.render_goals(response)
         # Temporarily make the goal buffer modifiable
         modifiable = self.goal_buffer.options["modifiable"]
         self.goal_buffer.options["modifiable"] = True
         try:
             cursors = get_cursors_for_buffer(self.goal_buffer)
-            del self.goal_buffer[:]
-
-            if response is None:
-                return False
-
-            goals = response.val
-            if goals is None:
-                self.goal_buffer[0] = 'No goals.'
-                return True
-
-            sub_goals = goals.fg
-            msg_format = '{0} subgoal{1}'
-            show_hyps = True
-            if not sub_goals:
-                show_hyps = False
-                sub_goals = []
-                for (before, after) in goals.bg:
-                    sub_goals.extend(reversed(before))
-                    sub_goals.extend(after)
-                if sub_goals:
-                    msg_format = ('This subproof is complete, but there {2} {0}'
-                                  ' unfocused goal{1}')
-            if not sub_goals:
-                msg_format = 'No more subgoals.'
-
-            nb_subgoals = len(sub_goals)
-            self.goal_buffer[0] = msg_format.format(nb_subgoals,
-                                                    '' if nb_subgoals == 1 else 's',
-                                                    'is' if nb_subgoals == 1 else 'are')
-            self.goal_buffer.append([''])
-
-            for idx, sub_goal in enumerate(sub_goals):
-                _id = sub_goal.id
-                hyps = sub_goal.hyp
-                ccl = sub_goal.ccl
-                if show_hyps:
-                    # we print the environment only for the current subgoal
-                    for hyp in hyps:
-                        lst = map(lambda s: s.encode('utf-8'), hyp.split('\n'))
-                        self.goal_buffer.append(list(lst))
-                    show_hyps = False
-                self.goal_buffer.append('')
-                self.goal_buffer.append('======================== ( %d / %d )' % (idx+1 , nb_subgoals))
-                lines = map(lambda s: s.encode('utf-8'), ccl.split('\n'))
-                self.goal_buffer.append(list(lines))
-                self.goal_buffer.append('')
+            old = self.goal_lines
+            if (old is None or self.goal_lines_bufnr != self.goal_buffer.number
+                    or len(old) != len(self.goal_buffer)):
+                # The current contents are unknown
+                edits = None
+            else:
+                edits = line_diff.line_edits(old, lines)
+                if line_diff.edit_cost(edits) >= len(lines):
+                    # Rewriting everything is cheaper
+                    edits = None
+            encode = lambda lst: [l.encode('utf-8') for l in lst]
+            if edits is None:
+                self.goal_buffer[:] = encode(lines)
+            else:
+                line_diff.apply_line_edits(
+                    self.goal_buffer,
+                    [(start, stop, encode(new))
+                     for (start, stop, new) in edits])
+            self.goal_lines = lines
+            self.goal_lines_bufnr = self.goal_buffer.number
 
             fix_scroll(cursors)
         finally:
             self.goal_buffer.options["modifiable"] = modifiable
-        return True
+        return response is not None
 
     def show_info(self, message):
         # Temporarily make the info buffer modifiable
@@ -374,10 +710,53 @@ class BufferState(object):
             fix_scroll(cursors)
         finally:
             self.info_buffer.options["modifiable"] = modifiable
+        # The next update_info rewrites the buffer
+        self.info_epoch = None
+
+    def update_info(self):
+        """
+        Shows the messages that coqtop sent since the last update_info. The
+        new messages are appended to the info buffer; it is only rewritten
+        after the messages were cleared, or when it was changed by something
+        else.
+        """
+        stale = (self.info_bufnr != self.info_buffer.number or
+                 len(self.info_buffer) != max(self.info_lines, 1) or
+                 # The log dropped most of what the buffer shows
+                 self.info_count > 2 * self.coq_top.messages.limit)
+        (seq, epoch, reset, messages) = self.coq_top.get_new_messages(
+                self.info_seq, None if stale else self.info_epoch)
+        self.info_seq = seq
+        self.info_epoch = epoch
+        self.info_bufnr = self.info_buffer.number
+        if not reset and not messages:
+            return
+        lines = []
+        if messages:
+            lines = [l.encode('utf-8')
+                     for l in "\n".join(messages).split('\n')]
+        # Temporarily make the info buffer modifiable
+        modifiable = self.info_buffer.options["modifiable"]
+        self.info_buffer.options["modifiable"] = True
+        try:
+            cursors = get_cursors_for_buffer(self.info_buffer)
+            if reset or self.info_lines == 0:
+                # An empty vim buffer still has 1 blank line, so it has to be
+                # overwritten instead of appended to.
+                self.info_buffer[:] = lines or [b'']
+                self.info_count = len(messages)
+                self.info_lines = len(lines)
+            else:
+                self.info_buffer.append(lines)
+                self.info_count += len(messages)
+                self.info_lines += len(lines)
+            fix_scroll(cursors)
+        finally:
+            self.info_buffer.options["modifiable"] = modifiable
 
     def clear_info(self):
         self.coq_top.clear_messages()
-        self.show_info(None)
+        self.update_info()
 
     def convert_offset(self, range_start, offset, range_end):
         message = self._between(range_start, range_end)
@@ -385,73 +764,16 @@ class BufferState(object):
                                              message, offset)
         return (line + range_start[0], col, byte)
 
-    def reset_color(self):
-        sent = []
-        checked = []
-        warnings = []
-        errors = []
-        prev_end = None
-        sent_start = None
-        checked_start = None
-        commands = self.coq_top.get_commands()
-        for c in commands:
-            if c.state in (CT.Command.REVERTED, CT.Command.ABANDONED):
-                break
-            if c.state == CT.Command.SENT:
-                if sent_start is None:
-                    # Start a sent range
-                    sent_start = prev_end
-            elif sent_start is not None:
-                # Finish a sent range
-                sent.append(make_vim_range(sent_start, prev_end))
-                sent_start = None
-
-            # Include all the processed commands as checked, even if they
-            # produced a warning or error message. A subrange will also be
-            # marked as a warning or error, but that will override the checked
-            # group.
-            if c.state == CT.Command.PROCESSED:
-                if checked_start is None:
-                    # Start a checked range
-                    checked_start = prev_end
-            elif checked_start is not None:
-                # Finish a checked range
-                checked.append(make_vim_range(checked_start, prev_end))
-                checked_start = None
-            prev_end = c.end
-        if sent_start is not None:
-            # Finish a sent range
-            sent.append(make_vim_range(sent_start, prev_end))
-        if checked_start is not None:
-            # Finish a checked range
-            checked.append(make_vim_range(checked_start, prev_end))
-        prev_end = None
-        for c in commands:
-            if c.msg_type != CT.Command.NONE:
-                # Normalize the start and stop positions, if it hasn't been done yet.
-                if c.msg_start_offset is not None and c.msg_start is None:
-                    c.msg_start = self.convert_offset(prev_end,
-                                                      c.msg_start_offset,
-                                                      c.end)
-                if c.msg_stop_offset is not None and c.msg_stop is None:
-                    c.msg_stop = self.convert_offset(prev_end,
-                                                     c.msg_stop_offset,
-                                                     c.end)
-                start = c.msg_start
-                stop = c.msg_stop
-                if start == stop:
-                    start = prev_end
-                    stop = c.end
-                if c.msg_type == CT.Command.WARNING:
-                    warnings.append(make_vim_range(start, stop))
-                else:
-                    errors.append(make_vim_range(start, stop))
-            prev_end = c.end
-        self.source_buffer.vars['coquille_sent'] = sent
-        self.source_buffer.vars['coquille_checked'] = checked
-        self.source_buffer.vars['coquille_warnings'] = warnings
-        self.source_buffer.vars['coquille_errors'] = errors
-        vim.command("call coquille#SyncBufferColors(%d)" %
+    def update_colors(self):
+        "Colors the commands that changed since the last update"
+        (removed, added) = self.colors.update(self.coq_top, self.visible)
+        if not removed and not added:
+            return
+        self.source_buffer.vars['coquille_colors_removed'] = (
+                make_vim_colors(removed))
+        self.source_buffer.vars['coquille_colors_added'] = (
+                make_vim_colors(added))
+        vim.command("call coquille#UpdateBufferColors(%d)" %
                     self.source_buffer.number)
 
     def rewind_to(self, line, col):
@@ -473,10 +795,8 @@ class BufferState(object):
             # state list.
             return
 
-        predicate = lambda x: (x.end[0], x.end[1]) <= (line, col)
-        commands = self.coq_top.get_active_commands()
-        lst = filter(predicate, commands)
-        steps = len(commands) - len(list(lst))
+        steps = (self.coq_top.get_active_command_count() -
+                 self.coq_top.count_active_commands_until(line, col))
         if steps != 0:
             self.coq_rewind(steps)
 
@@ -488,38 +808,224 @@ class BufferState(object):
         """
         Tries to send every message in [send_queue] to Coq, stops at the first
         error.
-        When this function returns, [send_queue] is empty.
+        When this function returns, [send_queue] is empty, unless
+        g:coquille_async is set. Then the commands are sent in the background,
+        and the poll timer shows the progress.
         """
         self.clear_info()
 
+        if (vim.vars.get('coquille_async', 0) and
+                int(vim.eval("has('timers')"))):
+            self.send_in_background(send_queue)
+            return
+
         # Start sending on a background thread
         self.coq_top.send_async(send_queue)
             
-        # Redraw the screen when the background thread makes progress
+        # Redraw the screen when the background thread makes progress, at
+        # most g:coquille_max_fps times per second. The final state is shown
+        # as soon as the thread is done.
+        scheduler = self.new_redraw_scheduler()
         while True:
-            result = self.coq_top.wait_for_result()
-            if result & CT.CoqTop.COMMAND_CHANGED:
-                self.reset_color()
-                vim.command('redraw')
-            if result & CT.CoqTop.MESSAGE_RECEIVED:
-                new_info = self.coq_top.get_messages()
-                self.show_info(new_info)
+            result = self.coq_top.wait_for_result(scheduler.timeout())
+            scheduler.add(result)
+            if result & CT.CoqTop.SEND_DONE or scheduler.due():
+                self.flush_ui(scheduler.take())
             if result & CT.CoqTop.SEND_DONE:
                 break
 
         self.coq_top.finish_send()
         self.refresh()
+        self.raise_high_water()
+
+    def send_in_background(self, send_queue, lookahead=False):
+        """
+        Starts sending [send_queue], and lets the poll timer show the progress.
+        If [lookahead] is set, the goals of each command are cached instead of
+        showing the goals at the end.
+        """
+        self.async_end = send_queue[-1][1] if send_queue else None
+        self.async_scheduler = self.new_redraw_scheduler()
+        self.coq_top.send_async(send_queue, fetch_goals=not lookahead,
+                                goals_each=lookahead)
+        vim.command("call coquille#StartPolling(%d)" %
+                    self.source_buffer.number)
+
+    def raise_high_water(self):
+        count = self.coq_top.get_active_command_count()
+        if self.visible is not None:
+            count = self.visible
+        self.high_water = max(self.high_water, count)
+
+    def start_lookahead(self):
+        """
+        Checks the next g:coquille_lookahead sentences in the background,
+        stopping after the end of a proof, so that the next CoqNext only has
+        to show their cached goals.
+        """
+        limit = int(vim.vars.get('coquille_lookahead', 0))
+        if (limit <= 0 or self.coq_top.coqtop is None or
+                self.coq_top.is_sending() or
+                not int(vim.eval("has('timers')"))):
+            return
+        count = self.coq_top.get_active_command_count()
+        visible = count if self.visible is None else self.visible
+        last = self.coq_top.get_last_active_command()
+        last_sent = ((0,0,0) if not last else last.end)
+        send_queue = deque([])
+        while count + len(send_queue) - visible < limit:
+            r = self._get_message_range(last_sent)
+            if r is None:
+                break
+            last_sent = r[1]
+            send_queue.append(r)
+            if proof_end.match(sentences.normalize(r[0])):
+                break
+        if send_queue:
+            self.visible = visible
+            self.send_in_background(send_queue, lookahead=True)
+
+    def lookahead_next(self):
+        """
+        Steps over the next command checked ahead, if it is ready. Returns
+        False if CoqNext has to send it instead.
+        """
+        if self.visible is None:
+            return False
+        self.sync()
+        if (self.visible is None or self.deferred is not None or
+                self.visible >= self.coq_top.get_active_command_count()):
+            return False
+        comm = self.coq_top.get_commands_at([self.visible])[0]
+        goals = self.coq_top.get_cached_goals(comm.state_id)
+        if goals is None:
+            return False
+        self.visible += 1
+        self.update_colors()
+        self.show_goal(goals)
+        # Keep g:coquille_lookahead commands ahead
+        self.start_lookahead()
+        return True
+
+    def drop_lookahead(self):
+        """
+        Stops checking ahead, and rewinds coqtop to the commands the user
+        stepped through. The rewound states are kept, so sending the same
+        commands again is cheap.
+        """
+        self.finish_async()
+        if self.visible is None:
+            return
+        steps = self.coq_top.get_active_command_count() - self.visible
+        self.visible = None
+        if steps > 0:
+            keep = self.coq_top.edit_forward is not False
+            if self.coq_top.rewind(steps, keep_states=keep) is None:
+                vim.command("call coquille#KillSession()")
+                print('ERROR: the Coq process died')
+                return
+        self.update_colors()
+
+    def continuous_check(self):
+        """
+        Called once the buffer stopped changing in continuous mode. Sends the
+        commands up to the high water mark, or up to the cursor, in the
+        background.
+        """
+        if self.coq_top.coqtop is None or self.suspended is not None:
+            return
+        if self.coq_top.is_sending():
+            # Check again once the send thread stopped, instead of waiting
+            # for coqtop here
+            self.cancel_async()
+            self.deferred = self.continuous_check
+            return
+        # Start over from the changes
+        self.drop_lookahead()
+        self.sync()
+        cursor = None
+        if int(vim.vars.get('coquille_continuous', 0)) == 2:
+            for window in vim.windows:
+                if window.buffer.number == self.source_buffer.number:
+                    cursor = window.cursor
+                    break
+        count = self.coq_top.get_active_command_count()
+        last = self.coq_top.get_last_active_command()
+        last_sent = ((0,0,0) if not last else last.end)
+        send_queue = deque([])
+        while True:
+            if cursor is None and count + len(send_queue) >= self.high_water:
+                break
+            r = self._get_message_range(last_sent)
+            if r is None:
+                break
+            if (cursor is not None and
+                    (r[1][0], r[1][1]) > (cursor[0] - 1, cursor[1] + 1)):
+                break
+            last_sent = r[1]
+            send_queue.append(r)
+        if send_queue:
+            self.clear_info()
+            self.send_in_background(send_queue)
+
+    def poll(self):
+        """
+        Shows the progress of the commands sent in the background. Returns
+        False once they are all checked.
+        """
+        if not self.coq_top.is_sending():
+            return False
+        result = self.coq_top.wait_for_result(0)
+        self.async_scheduler.add(result)
+        done = result & CT.CoqTop.SEND_DONE
+        if done:
+            self.coq_top.finish_send()
+            self.async_end = None
+            if not self.coq_top.send_cancelled:
+                self.raise_high_water()
+            # Pick up the changes made since the last result
+            self.async_scheduler.add(CT.CoqTop.COMMAND_CHANGED |
+                                     CT.CoqTop.MESSAGE_RECEIVED)
+        if done or self.async_scheduler.due():
+            self.flush_ui(self.async_scheduler.take())
+        if done and self.deferred is not None:
+            deferred = self.deferred
+            self.deferred = None
+            deferred()
+        # The deferred call may have started sending again
+        return self.coq_top.is_sending()
+
+    def cancel_async(self):
+        """
+        Stops sending the commands queued by send_until_fail. It does not wait
+        for coqtop: the send thread stops after the call in progress, and poll
+        reaps it.
+        """
+        if not self.coq_top.is_sending():
+            return
+        self.coq_top.cancel_send()
+        self.async_end = None
+
+    def finish_async(self):
+        """
+        Cancels the commands sent in the background, and waits for the send
+        thread to stop, for the callers that talk to coqtop next.
+        """
+        self.cancel_async()
+        self.deferred = None
+        if not self.coq_top.is_sending():
+            return
+        self.coq_top.finish_send()
+        self.flush_ui(self.async_scheduler.take() |
+                      CT.CoqTop.COMMAND_CHANGED | CT.CoqTop.MESSAGE_RECEIVED)
 
     #################
     # Miscellaneous #
     #################
 
-    # col_offset is a character offset, not byte offset
-    def _get_remaining_line(self, line, col_offset):
-        s = self.source_buffer[line]
-        if not isinstance(s, unicode):
-            s = s.decode("utf-8")
-        return s[col_offset:]
+    def _changedtick(self):
+        return vim.eval('getbufvar(%d, "changedtick")' %
+                        self.source_buffer.number)
 
     def _between(self, begin, end):
         """
@@ -563,146 +1069,17 @@ class BufferState(object):
                                     (eline, ecol - 1, ebyte - 1))
             return (message, end_pos)
 
-    # A bullet is:
-    # - One or more '-'
-    # - One or more '+'
-    # - One or more '*'
-    # - Exactly 1 '{' (additional ones are parsed as separate statements)
-    # - Exactly 1 '}' (additional ones are parsed as separate statements)
-    bullets = re.compile("-+|\++|\*+|{|}")
-
     def _find_next_chunk(self, line, col):
         """
         Returns the position of the next chunk dot after a certain position.
-        That can either be a bullet if we are in a proof, or "a string" terminated
-        by a dot (outside of a comment, and not denoting a path).
-        """
-        blen = len(self.source_buffer)
-        # We start by striping all whitespaces (including \n) from the beginning of
-        # the chunk.
-        while line < blen:
-            line_val = self.source_buffer[line]
-            if not isinstance(line_val, unicode):
-                line_val = line_val.decode("utf-8")
-            while col < len(line_val) and line_val[col] in (' ', '\t'):
-                col += 1
-            if col < len(line_val) and line_val[col] not in (' ', '\t'):
-                break
-            line += 1
-            col = 0
-
-        if line >= blen: return
-
-        # Then we check if the first character of the chunk is a bullet.
-        # Intially I did that only when I was sure to be in a proof (by looking in
-        # [encountered_dots] whether I was after a "collapsable" chunk or not), but
-        #   1/ that didn't play well with coq_to_cursor (as the "collapsable chunk"
-        #      might not have been sent/detected yet).
-        #   2/ The bullet chars can never be used at the *beginning* of a chunk
-        #      outside of a proof. So the check was unecessary.
-        bullet_match = self.bullets.match(line_val, col)
-        if bullet_match:
-            return (line, bullet_match.end())
-
-        # We might have a commentary before the bullet, we should be skiping it and
-        # keep on looking.
-        tail_len = len(line_val) - col
-        if ((tail_len - 1 > 0) and line_val[col] == '('
-                and line_val[col + 1] == '*'):
-            com_end = self._skip_comment(line, col + 2, 1)
-            if not com_end: return
-            (line, col) = com_end
-            return self._find_next_chunk(line, col)
-
-
-        # If the chunk doesn't start with a bullet, we look for a dot.
-        dot = self._find_dot_after(line, col)
-        if dot:
-            # Return the position one after the dot
-            return (dot[0], dot[1] + 1)
-        else:
-            return None
-
-    def _find_dot_after(self, line, col):
-        """
-        Returns the position of the next "valid" dot after a certain position.
-        Valid here means: recognized by Coq as terminating an input, so dots in
-        comments, strings or ident paths are not valid.
-        """
-        if line >= len(self.source_buffer): return
-        s = self._get_remaining_line(line, col)
-        dot_pos = s.find('.')
-        com_pos = s.find('(*')
-        str_pos = s.find('"')
-        if com_pos == -1 and dot_pos == -1 and str_pos == -1:
-            # Nothing on this line
-            return self._find_dot_after(line + 1, 0)
-        elif dot_pos == -1 or (com_pos > - 1 and dot_pos > com_pos) or (str_pos > - 1 and dot_pos > str_pos):
-            if str_pos == -1 or (com_pos > -1 and str_pos > com_pos):
-                # We see a comment opening before the next dot
-                com_end = self._skip_comment(line, com_pos + 2 + col, 1)
-                if not com_end: return
-                (line, col) = com_end
-                return self._find_dot_after(line, col)
-            else:
-                # We see a string starting before the next dot
-                str_end = self._skip_str(line, str_pos + col + 1)
-                if not str_end: return
-                (line, col) = str_end
-                return self._find_dot_after(line, col)
-        elif dot_pos < len(s) - 1 and s[dot_pos + 1] != ' ':
-            # Sometimes dot are used to access module fields, we don't want to stop
-            # just after the module name.
-            # Example: [Require Import Coq.Arith]
-            return self._find_dot_after(line, col + dot_pos + 1)
-        elif dot_pos + col > 0 and self._get_remaining_line(line, col + dot_pos - 1)[0] == '.':
-            # FIXME? There might be a cleaner way to express this.
-            # We don't want to capture ".."
-            if dot_pos + col > 1 and self._get_remaining_line(line, col + dot_pos - 2)[0] == '.':
-                # But we want to capture "..."
-                return (line, dot_pos + col)
-            else:
-                return self._find_dot_after(line, col + dot_pos + 1)
-        else:
-            return (line, dot_pos + col)
-
-    # TODO? factorize [_skip_str] and [_skip_comment]
-    def _skip_str(self, line, col):
-        """
-        Used when we encountered the start of a string before a valid dot (see
-        [_find_dot_after]).
-        Returns the position of the end of the string.
+        See [sentences.find_next_chunk].
         """
-        while True:
-            if line >= len(self.source_buffer): return
-            s = self._get_remaining_line(line, col)
-            str_end = s.find('"')
-            if str_end > -1:
-                return (line, col + str_end + 1)
-            line += 1
-            col = 0
-
-    def _skip_comment(self, line, col, nb_left):
-        """
-        Used when we encountered the start of a comment before a valid dot (see
-        [_find_dot_after]).
-        Returns the position of the end of the comment.
-        """
-        while nb_left > 0:
-            if line >= len(self.source_buffer): return None
-            s = self._get_remaining_line(line, col)
-            com_start = s.find('(*')
-            com_end = s.find('*)')
-            if com_end > -1 and (com_end < com_start or com_start == -1):
-                col += com_end + 2
-                nb_left -= 1
-            elif com_start > -1:
-                col += com_start + 2
-                nb_left += 1
-            else:
-                line += 1
-                col = 0
-        return (line, col)
+        tick = self._changedtick()
+        if tick != self.sentence_tick:
+            # The buffer changed without going through sync()
+            self.sentence_index.invalidate(0)
+            self.sentence_tick = tick
+        return self.sentence_index.next_end(line, col)
 
 def _empty_range():
     return [ { 'line': 0, 'col': 0}, { 'line': 0, 'col': 0} ]
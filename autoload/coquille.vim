@@ -27,6 +27,67 @@ let s:active_winnr = -1
 if !exists('coquille_auto_move')
     let g:coquille_auto_move="false"
 endif
+" The most times per second the screen is redrawn while coqtop is checking
+" commands. 0 redraws after every change.
+if !exists('g:coquille_max_fps')
+    let g:coquille_max_fps = 30
+endif
+" When set to 1, CoqNext and CoqToCursor return immediately, and the commands
+" are checked in the background while a timer shows the progress. This needs
+" the timers feature.
+if !exists('g:coquille_async')
+    let g:coquille_async = 0
+endif
+" When set to 1, the commands are checked again in the background once the
+" buffer has not changed for g:coquille_continuous_delay milliseconds, up to
+" the furthest command checked so far. When set to 2, up to the cursor. This
+" needs the timers feature.
+if !exists('g:coquille_continuous')
+    let g:coquille_continuous = 0
+endif
+if !exists('g:coquille_continuous_delay')
+    let g:coquille_continuous_delay = 500
+endif
+" The number of sentences after the last one CoqNext stepped over to check
+" in the background, stopping at the end of a proof. CoqNext then shows
+" their goals without waiting for coqtop. 0 disables it. This needs the timers
+" feature.
+if !exists('g:coquille_lookahead')
+    let g:coquille_lookahead = 0
+endif
+" Sentences that coqtop took at least this many seconds to process are
+" highlighted with CoqSlow. 0 disables it.
+if !exists('g:coquille_slow_threshold')
+    let g:coquille_slow_threshold = 0
+endif
+" The most messages kept for the info panel. Older messages are dropped.
+if !exists('g:coquille_max_messages')
+    let g:coquille_max_messages = 1000
+endif
+" The number of coqtop processes to start ahead of time for each set of coqtop
+" arguments, so CoqLaunch does not wait for coqtop to start. 0 disables it.
+if !exists('g:coquille_pool_size')
+    let g:coquille_pool_size = 0
+endif
+" Pre-started coqtop processes unused for this many seconds are stopped
+if !exists('g:coquille_pool_idle_timeout')
+    let g:coquille_pool_idle_timeout = 600
+endif
+" No more coqtop processes are pre-started while the unused ones take this
+" many megabytes of memory. 0 is no limit.
+if !exists('g:coquille_pool_max_memory')
+    let g:coquille_pool_max_memory = 0
+endif
+" The most buffers that run coqtop at once. When more are used, coqtop is
+" stopped in the least recently used ones, and their commands are sent again
+" when they are used next. 0 is no limit.
+if !exists('g:coquille_max_sessions')
+    let g:coquille_max_sessions = 0
+endif
+" The same, but for the megabytes of memory used by the coqtop processes
+if !exists('g:coquille_max_session_memory')
+    let g:coquille_max_session_memory = 0
+endif
 
 " Return true if win_getid works
 function! coquille#Test_win_getid()
@@ -215,6 +276,11 @@ function! coquille#OpenSupportingBuffers(bufid, ...)
                     \ "> call coquille#Python('"
                     \ "coquille.BufferState.lookup_bufid(".
                     \ a:bufid . ").sync()')"
+        " Sync changes made in normal mode too while commands are checked in
+        " the background, and in continuous mode, check the buffer again once
+        " it stops changing
+        execute "autocmd TextChanged,TextChangedI <buffer=" . a:bufid .
+                    \ "> call coquille#TextChanged(" . a:bufid . ")"
         " initialize the plugin (launch coqtop)
         let l:result = coquille#PythonExpr(
                     \ 'coquille.BufferState.lookup_bufid(' .
@@ -615,61 +681,127 @@ function! coquille#UpdateSupportingWindows(winid, hint_tabnr, hint_winnr)
     call setbufvar(l:bufid, "coquille_block_activate", 0)
 endfunction
 
-" Create the pattern string to match from start until stop
+" Map from buffer variable name to [highlight group, priority]. The buffer
+" variables are set by coquille.py to lists of ranges in the format
+" [[start_line, start_col], [stop_line, stop_col]].
 "
-" start and stop are in the format: [line, col].
+" The lines and columns are 1-based byte positions. The start position is
+" included in the range, and the stop position is excluded.
+let s:color_groups = {
+\       "coquille_checked": ["CheckedByCoq", 10],
+\       "coquille_sent": ["SentToCoq", 10],
+\       "coquille_errors": ["CoqError", 11],
+\       "coquille_warnings": ["CoqWarning", 11],
+\       "coquille_slow": ["CoqSlow", 12]
+\   }
+
+" Return the API used to color the ranges:
+"   'textprop' - Vim text properties, attached to the buffer.
+"   'extmark'  - Neovim extmarks, attached to the buffer.
+"   'match'    - matchaddpos(), attached to each window.
 "
-" The lines and columns are 1-based. The start position is included in the
-" match (unless excluded by stop), and the final column in the stop position
-" is excluded.
-"
-" For the stop position, a line of -1 means highlight until the end of the
-" file. A column of -1 means highlight until the end of the specified line.
-function! coquille#GetRangePattern(start, stop)
-    if a:start[0] > a:stop[0]
-        let l:pattern = ''
-    elseif a:start[0] == a:stop[0]
-        " Start the pattern by matching anything on the start line
-        let l:pattern = printf('\%%%dl', a:start[0])
-        if a:start[1] > 1
-            " Refine the pattern to only match columns > (start[1]-1).
-            let l:pattern .= printf('\%%>%dc', a:start[1] - 1)
-        endif
-        if a:stop[1] != -1
-            " Refine the pattern to only match columns < (stop[1]).
-            let l:pattern .= printf('\%%<%dc', a:stop[1])
-        endif
+" This can be overriden by setting g:coquille_highlight_backend.
+function! coquille#HighlightBackend()
+    if exists('g:coquille_highlight_backend')
+        return g:coquille_highlight_backend
+    elseif exists('*nvim_buf_set_extmark')
+        return 'extmark'
+    elseif has('textprop')
+        return 'textprop'
     else
-        " Start the pattern by matching anything on the start line
-        let l:pattern = printf('\%%%dl', a:start[0])
-        if a:start[1] > 1
-            " Refine the pattern to only match columns > (start[1]-1) on
-            " the first line.
-            let l:pattern .= printf('\%%>%dc', a:start[1] - 1)
-        endif
-        " Create a new branch in the pattern which matches any column of the
-        " lines [start[0] + 1, stop[0] - 1] (bounds included).
-        "
-        " Create one more branch that matches any column in stop[0].
-        let l:pattern .= printf('\|\%%>%dl\%%<%dl\|\%%%dl',
-                    \           a:start[0],
-                    \           a:stop[0],
-                    \           a:stop[0])
-        if a:stop['col'] != -1
-            " Refine that last branch to only match columns < (stop[1]).
-            let l:pattern .= printf('\%%<%dc', a:stop[1])
+        return 'match'
+    endif
+endfunction
+
+" Longer than any line. matchaddpos() highlights until the end of the line.
+let s:max_line_length = 0x7fffffff
+
+" Return the matchaddpos() positions that cover the range from start to stop.
+function! coquille#GetRangePositions(start, stop)
+    if a:start[0] == a:stop[0]
+        if a:stop[1] <= a:start[1]
+            return []
         endif
+        return [[a:start[0], a:start[1], a:stop[1] - a:start[1]]]
+    endif
+    " The rest of the first line, then the whole lines in between
+    let l:positions = [[a:start[0], a:start[1], s:max_line_length]]
+    let l:positions += range(a:start[0] + 1, a:stop[0] - 1)
+    if a:stop[1] > 1
+        call add(l:positions, [a:stop[0], 1, a:stop[1] - 1])
     endif
-    return l:pattern
+    return l:positions
+endfunction
+
+" Add a highlight for range in the current window. Returns the list of match
+" ids, because older versions of matchaddpos() take at most 8 positions.
+function! coquille#MatchAddRange(group, range)
+    let l:group_info = s:color_groups[a:group]
+    let l:positions = coquille#GetRangePositions(a:range[0], a:range[1])
+    let l:matchids = []
+    let l:i = 0
+    while l:i < len(l:positions)
+        call add(l:matchids, matchaddpos(l:group_info[0],
+                    \                    l:positions[l:i : l:i + 7],
+                    \                    l:group_info[1]))
+        let l:i += 8
+    endwhile
+    return l:matchids
+endfunction
+
+function! coquille#MatchDeleteRange(group, matchids)
+    for l:matchid in a:matchids
+        call matchdelete(l:matchid)
+    endfor
+endfunction
+
+" Add a highlight for range in bufid, with a text property or extmark. Returns
+" a list with its id, or an empty list if the range is no longer in the
+" buffer.
+function! coquille#BufAddRange(backend, bufid, group, range)
+    let l:group_info = s:color_groups[a:group]
+    try
+        if a:backend == 'extmark'
+            return [nvim_buf_set_extmark(a:bufid, s:extmark_ns,
+                        \ a:range[0][0] - 1, a:range[0][1] - 1,
+                        \ {'end_row': a:range[1][0] - 1,
+                        \  'end_col': a:range[1][1] - 1,
+                        \  'hl_group': l:group_info[0],
+                        \  'priority': l:group_info[1]})]
+        endif
+        if empty(prop_type_get(a:group))
+            call prop_type_add(a:group, {'highlight': l:group_info[0],
+                        \                'priority': l:group_info[1]})
+        endif
+        let s:next_prop_id += 1
+        call prop_add(a:range[0][0], a:range[0][1],
+                    \ {'type': a:group, 'bufnr': a:bufid,
+                    \  'id': s:next_prop_id,
+                    \  'end_lnum': a:range[1][0],
+                    \  'end_col': a:range[1][1]})
+        return [s:next_prop_id]
+    catch
+        " The buffer changed since the range was computed. Since the buffer
+        " changed, coquille.py will rewind and update the colors again.
+        return []
+    endtry
 endfunction
 
-function! coquille#GetRangeListPattern(lst)
-    return join(map(copy(a:lst),
-            \       'coquille#GetRangePattern(v:val[0], v:val[1])'),
-            \   '\|')
+function! coquille#BufDeleteRange(backend, bufid, group, ids)
+    for l:id in a:ids
+        if a:backend == 'extmark'
+            call nvim_buf_del_extmark(a:bufid, s:extmark_ns, l:id)
+        else
+            call prop_remove({'type': a:group, 'bufnr': a:bufid, 'id': l:id,
+                        \     'both': 1, 'all': 1})
+        endif
+    endfor
 endfunction
 
-let s:empty_range = [ { 'line': 0, 'col': 0}, { 'line': 0, 'col': 0} ]
+let s:next_prop_id = 0
+if exists('*nvim_create_namespace')
+    let s:extmark_ns = nvim_create_namespace('coquille')
+endif
 
 function! coquille#FixWindowScroll(winid, hint_tabnr, hint_winnr)
     let l:cur_tab = tabpagenr()
@@ -701,7 +833,167 @@ function! coquille#FixWindowScrollTabWin(tabnr, winnr)
     return coquille#FixWindowScroll(l:winid, a:tabnr, a:winnr)
 endfunction
 
-function! coquille#SyncWindowColors(winid, hint_tabnr, hint_winnr)
+" Return b:coquille_colors of bufid. It maps each variable name of
+" s:color_groups to the ranges to color with that group, as a map from
+" string(range) to range.
+function! coquille#GetBufferColors(bufid)
+    let l:colors = getbufvar(a:bufid, "coquille_colors", {})
+    if empty(l:colors)
+        for group in keys(s:color_groups)
+            let l:colors[l:group] = {}
+        endfor
+        call setbufvar(a:bufid, "coquille_colors", l:colors)
+    endif
+    return l:colors
+endfunction
+
+" Return -1, 0 or 1 as the [line, col] position a is before, at, or after b.
+function! coquille#ComparePositions(a, b)
+    if a:a[0] != a:b[0]
+        return a:a[0] < a:b[0] ? -1 : 1
+    endif
+    return a:a[1] == a:b[1] ? 0 : a:a[1] < a:b[1] ? -1 : 1
+endfunction
+
+function! coquille#CompareRanges(a, b)
+    return coquille#ComparePositions(a:a[0], a:b[0])
+endfunction
+
+" The 'match' backend colors runs of contiguous ranges of the same group
+" instead of each range, so that a large checked region does not add a match
+" for each command. The runs of a group are kept as a dict with:
+"   ranges - a map from string(run) to run, in the format of b:coquille_colors
+"   starts - a map from string(start) of each run to string(run)
+"   stops  - a map from string(stop) of each run to string(run)
+
+function! coquille#AddRun(runs, run, changed)
+    let l:key = string(a:run)
+    let a:runs.ranges[l:key] = a:run
+    let a:runs.starts[string(a:run[0])] = l:key
+    let a:runs.stops[string(a:run[1])] = l:key
+    call add(a:changed, l:key)
+endfunction
+
+function! coquille#RemoveRun(runs, key, changed)
+    let l:run = remove(a:runs.ranges, a:key)
+    call remove(a:runs.starts, string(l:run[0]))
+    call remove(a:runs.stops, string(l:run[1]))
+    call add(a:changed, a:key)
+    return l:run
+endfunction
+
+" Return the runs of ranges, a map from string(range) to range.
+function! coquille#MergeRanges(ranges)
+    let l:runs = {'ranges': {}, 'starts': {}, 'stops': {}}
+    let l:changed = []
+    let l:run = []
+    for l:range in sort(values(a:ranges), 'coquille#CompareRanges')
+        if !empty(l:run) && l:run[1] == l:range[0]
+            let l:run[1] = l:range[1]
+            continue
+        endif
+        if !empty(l:run)
+            call coquille#AddRun(l:runs, l:run, l:changed)
+        endif
+        let l:run = [l:range[0], l:range[1]]
+    endfor
+    if !empty(l:run)
+        call coquille#AddRun(l:runs, l:run, l:changed)
+    endif
+    return l:runs
+endfunction
+
+" Update runs for the ranges of its group that were removed, then added.
+" Returns the keys of the runs that were removed or added.
+function! coquille#UpdateRuns(runs, removed, added)
+    let l:changed = []
+    for l:range in a:removed
+        " Find the run that contains the range, and split it around it
+        let l:key = get(a:runs.starts, string(l:range[0]),
+                    \   get(a:runs.stops, string(l:range[1]), ''))
+        if empty(l:key)
+            for [l:run_key, l:run] in items(a:runs.ranges)
+                if coquille#ComparePositions(l:run[0], l:range[0]) < 0 &&
+                            \ coquille#ComparePositions(l:range[1], l:run[1]) < 0
+                    let l:key = l:run_key
+                    break
+                endif
+            endfor
+        endif
+        if empty(l:key)
+            continue
+        endif
+        let l:run = coquille#RemoveRun(a:runs, l:key, l:changed)
+        if l:run[0] != l:range[0]
+            call coquille#AddRun(a:runs, [l:run[0], l:range[0]], l:changed)
+        endif
+        if l:range[1] != l:run[1]
+            call coquille#AddRun(a:runs, [l:range[1], l:run[1]], l:changed)
+        endif
+    endfor
+    for l:range in a:added
+        " Join the runs that end where it starts, and start where it ends
+        let l:run = [l:range[0], l:range[1]]
+        let l:key = get(a:runs.stops, string(l:range[0]), '')
+        if !empty(l:key)
+            let l:run[0] = coquille#RemoveRun(a:runs, l:key, l:changed)[0]
+        endif
+        let l:key = get(a:runs.starts, string(l:range[1]), '')
+        if !empty(l:key)
+            let l:run[1] = coquille#RemoveRun(a:runs, l:key, l:changed)[1]
+        endif
+        call coquille#AddRun(a:runs, l:run, l:changed)
+    endfor
+    return l:changed
+endfunction
+
+" Return b:coquille_runs of bufid. It maps each variable name of
+" s:color_groups to the runs of its ranges in b:coquille_colors.
+function! coquille#GetBufferRuns(bufid)
+    let l:runs = getbufvar(a:bufid, "coquille_runs", {})
+    if empty(l:runs)
+        let l:colors = coquille#GetBufferColors(a:bufid)
+        for group in keys(s:color_groups)
+            let l:runs[l:group] = coquille#MergeRanges(l:colors[l:group])
+        endfor
+        call setbufvar(a:bufid, "coquille_runs", l:runs)
+    endif
+    return l:runs
+endfunction
+
+" Update the colors of the ranges that changed since the last sync. applied
+" maps each colored range (as a string) to the ids that color it, and wanted
+" maps each range that should be colored (as a string) to the range. applied
+" is updated in place.
+"
+" add_func is called with args + [range] and returns the new ids, and
+" delete_func is called with args + [ids] for each range that is no longer
+" wanted. If the optional argument is given, it is the list of the only
+" ranges (as strings) that could have changed.
+function! coquille#SyncRanges(applied, wanted, add_func, delete_func, args, ...)
+    let l:keys = a:0 ? a:1 : keys(a:applied) + keys(a:wanted)
+    for l:key in l:keys
+        if has_key(a:wanted, l:key)
+            if !has_key(a:applied, l:key)
+                let l:ids = call(a:add_func, a:args + [a:wanted[l:key]])
+                if !empty(l:ids)
+                    let a:applied[l:key] = l:ids
+                endif
+            endif
+        elseif has_key(a:applied, l:key)
+            call call(a:delete_func, a:args + [remove(a:applied, l:key)])
+        endif
+    endfor
+endfunction
+
+" Bring the matches of winid up to date with the runs of its buffer. If the
+" optional argument is given, it maps each variable name to the keys of the
+" only runs that changed since the previous colors tick.
+function! coquille#SyncWindowColors(winid, hint_tabnr, hint_winnr, ...)
+    if coquille#HighlightBackend() != 'match'
+        " The colors are attached to the buffer instead
+        return 0
+    endif
     let l:cur_tab = tabpagenr()
     let l:cur_win = winnr()
     let l:tabwin = coquille#WinId2TabWin(a:winid, a:hint_tabnr, a:hint_winnr)
@@ -711,73 +1003,207 @@ function! coquille#SyncWindowColors(winid, hint_tabnr, hint_winnr)
         return 0
     endif
     let l:bufnr = coquille#TabWinBufnr(l:tabwin[0], l:tabwin[1])
-    " Map from variable name to [group name, priority]
-    let l:group_infos = {
-    \       "coquille_checked": ["CheckedByCoq", 10],
-    \       "coquille_sent": ["SentToCoq", 10],
-    \       "coquille_errors": ["CoqError", 11],
-    \       "coquille_warnings": ["CoqWarning", 11]
-    \   }
-
-    let l:switched = 0
-    for group in keys(l:group_infos)
-        let l:win_value = coquille#GetWinVar(a:winid, l:tabwin[0], l:tabwin[1],
-                    \                        l:group, [s:empty_range, -1])
-        let l:buf_value = getbufvar(l:bufnr, l:group, s:empty_range)
-        if l:win_value[0] == l:buf_value
-            " It already matches; nothing to do
-            continue
+    let l:tick = getbufvar(l:bufnr, "coquille_colors_tick", 0)
+    " The window variable holds [bufnr, tick, map from variable name to the
+    " match ids of each run, see coquille#SyncRanges]
+    let l:win_value = coquille#GetWinVar(a:winid, l:tabwin[0], l:tabwin[1],
+                \                        "coquille_colors", [-1, 0, {}])
+    if l:win_value[0:1] == [l:bufnr, l:tick]
+        " It already matches; nothing to do
+        return 0
+    endif
+    " matchaddpos() only works for the current window. So switch to a:winid.
+    let l:cur_winid = coquille#WinGetId(l:cur_tab, l:cur_win)
+    call coquille#WinGoToId(a:winid, l:tabwin[0], l:tabwin[1])
+    " Switching the window could have triggered the colors to get synced.
+    " So double check that they need to be synced.
+    let l:win_value = coquille#GetWinVar(a:winid, tabpagenr(), winnr(),
+                \                        "coquille_colors", [-1, 0, {}])
+    if l:win_value[0:1] != [l:bufnr, l:tick]
+        let l:runs = coquille#GetBufferRuns(l:bufnr)
+        " The changed runs are enough if the window has the colors from just
+        " before them
+        let l:changed_only = a:0 && l:win_value[0:1] == [l:bufnr, l:tick - 1]
+        for group in keys(s:color_groups)
+            if !has_key(l:win_value[2], l:group)
+                let l:win_value[2][l:group] = {}
+            endif
+            let l:args = [l:win_value[2][l:group], l:runs[l:group].ranges,
+                        \ 'coquille#MatchAddRange', 'coquille#MatchDeleteRange',
+                        \ [l:group]]
+            if l:changed_only
+                call add(l:args, get(a:1, l:group, []))
+            endif
+            call call('coquille#SyncRanges', l:args)
+        endfor
+        call coquille#SetWinVar(a:winid, tabpagenr(), winnr(),
+                    \           "coquille_colors",
+                    \           [l:bufnr, l:tick, l:win_value[2]])
+    endif
+    " Switch back to the original window
+    call coquille#WinGoToId(l:cur_winid, l:cur_tab, l:cur_win)
+    return 1
+endfunction
+
+" Bring the colors of bufid up to date with b:coquille_colors. If the optional
+" argument is given, it is the list of the only [variable name, range] pairs
+" that changed since the last sync.
+function! coquille#SyncBufferColors(bufid, ...)
+    let l:backend = coquille#HighlightBackend()
+    let l:colors = coquille#GetBufferColors(a:bufid)
+    if l:backend == 'match'
+        let l:runs = getbufvar(a:bufid, "coquille_runs", {})
+        let l:window_args = [0, 0]
+        if a:0 && !empty(l:runs)
+            " The ranges still in b:coquille_colors were added, the others
+            " removed
+            let l:removed = {}
+            let l:added = {}
+            for group in keys(s:color_groups)
+                let l:removed[l:group] = []
+                let l:added[l:group] = []
+            endfor
+            for [l:group, l:range] in a:1
+                if has_key(l:colors[l:group], string(l:range))
+                    call add(l:added[l:group], l:range)
+                else
+                    call add(l:removed[l:group], l:range)
+                endif
+            endfor
+            let l:changed = {}
+            for group in keys(s:color_groups)
+                let l:changed[l:group] = coquille#UpdateRuns(l:runs[l:group],
+                            \ l:removed[l:group], l:added[l:group])
+            endfor
+            call add(l:window_args, l:changed)
+        else
+            " Merge the ranges again
+            call setbufvar(a:bufid, "coquille_runs", {})
+            call coquille#GetBufferRuns(a:bufid)
         endif
-        " matchadd() only works for the current window. So switch to a:winid.
-        if !l:switched
-            let l:cur_winid = coquille#WinGetId(l:cur_tab, l:cur_win)
-            call coquille#WinGoToId(a:winid, l:tabwin[0], l:tabwin[1])
-            let l:switched = 1
-        endif
-        " Switching the window could have triggered the colors to get synced.
-        " So double check that they need to be synced.
-        let l:win_value = coquille#GetWinVar(a:winid, tabpagenr(), winnr(),
-                    \                        l:group, [s:empty_range, -1])
-        if l:win_value[0] == l:buf_value
-            " It already matches; nothing to do
-            continue
+        call setbufvar(a:bufid, "coquille_colors_tick",
+                    \  getbufvar(a:bufid, "coquille_colors_tick", 0) + 1)
+        for winid in coquille#WinFindBuf(a:bufid)
+            call call('coquille#SyncWindowColors', [l:winid] + l:window_args)
+        endfor
+        return
+    endif
+    " Map from variable name to the ids of each range, see
+    " coquille#SyncRanges
+    let l:applied = getbufvar(a:bufid, "coquille_color_ids", {})
+    call setbufvar(a:bufid, "coquille_color_ids", l:applied)
+    let l:changed = {}
+    for group in keys(s:color_groups)
+        if !has_key(l:applied, l:group)
+            let l:applied[l:group] = {}
+        endif
+        let l:changed[l:group] = []
+    endfor
+    if a:0
+        for [l:group, l:range] in a:1
+            call add(l:changed[l:group], string(l:range))
+        endfor
+    endif
+    for group in keys(s:color_groups)
+        let l:args = [l:applied[l:group], l:colors[l:group],
+                    \ 'coquille#BufAddRange', 'coquille#BufDeleteRange',
+                    \ [l:backend, a:bufid, l:group]]
+        if a:0
+            call add(l:args, l:changed[l:group])
         endif
-        if l:win_value[1] != -1
-            call matchdelete(l:win_value[1])
+        call call('coquille#SyncRanges', l:args)
+    endfor
+endfunction
+
+" Apply the changes that coquille.py stored in b:coquille_colors_removed and
+" b:coquille_colors_added, two lists of [variable name, range] pairs.
+function! coquille#UpdateBufferColors(bufid)
+    let l:colors = coquille#GetBufferColors(a:bufid)
+    let l:removed = getbufvar(a:bufid, "coquille_colors_removed", [])
+    let l:added = getbufvar(a:bufid, "coquille_colors_added", [])
+    " The pairs that really changed
+    let l:changed = []
+    for [l:group, l:range] in l:removed
+        let l:key = string(l:range)
+        if has_key(l:colors[l:group], l:key)
+            call remove(l:colors[l:group], l:key)
+            call add(l:changed, [l:group, l:range])
         endif
-        if l:buf_value == s:empty_range
-            let l:matchid = -1
-        else
-            let l:group_info = l:group_infos[l:group]
-            let l:matchid = matchadd(l:group_info[0],
-                        \            coquille#GetRangeListPattern(l:buf_value),
-                        \            l:group_info[1])
+    endfor
+    for [l:group, l:range] in l:added
+        let l:key = string(l:range)
+        if !has_key(l:colors[l:group], l:key)
+            let l:colors[l:group][l:key] = l:range
+            call add(l:changed, [l:group, l:range])
         endif
-        call coquille#SetWinVar(a:winid, l:tabwin[0], l:tabwin[1],
-                    \           l:group, [l:buf_value, l:matchid])
     endfor
-    if l:switched
-        " Switch back to the original window
-        call coquille#WinGoToId(l:cur_winid, l:cur_tab, l:cur_win)
+    call coquille#SyncBufferColors(a:bufid, l:changed)
+endfunction
+
+" Remove all the colors from bufid
+function! coquille#ClearBufferColors(bufid)
+    for l:ranges in values(coquille#GetBufferColors(a:bufid))
+        call filter(l:ranges, 0)
+    endfor
+    call coquille#SyncBufferColors(a:bufid)
+endfunction
+
+" Map from the id of a poll timer to the source buffer it updates
+let s:poll_timers = {}
+
+" Map from a source buffer to the timer of its next continuous check
+let s:check_timers = {}
+
+function! coquille#TextChanged(bufid)
+    call coquille#Python('coquille.BufferState.lookup_bufid(' . a:bufid .
+                \ ').text_changed()')
+    call coquille#ScheduleCheck(a:bufid)
+endfunction
+
+" Restart the continuous checking timer of bufid, see g:coquille_continuous
+function! coquille#ScheduleCheck(bufid)
+    if !g:coquille_continuous || !has('timers')
+        return
     endif
-    return l:switched
+    if has_key(s:check_timers, a:bufid)
+        call timer_stop(remove(s:check_timers, a:bufid))
+    endif
+    let s:check_timers[a:bufid] = timer_start(g:coquille_continuous_delay,
+                \ function('coquille#ContinuousCheck', [a:bufid]))
 endfunction
 
-function! coquille#SyncBufferColors(bufid)
-    let l:old_redraw = &lazyredraw
-    if !l:old_redraw
-        "set lazyredraw
+function! coquille#ContinuousCheck(bufid, timer)
+    if get(s:check_timers, a:bufid, -1) != a:timer
+        return
     endif
-    let l:need_redraw = 0
-    for winid in coquille#WinFindBuf(a:bufid)
-        if coquille#SyncWindowColors(l:winid, 0, 0)
-            let l:need_redraw = 1
-        endif
-    endfor
-    if !l:old_redraw
-        "set nolazyredraw
-        if l:need_redraw
-            "redraw
+    call remove(s:check_timers, a:bufid)
+    if getbufvar(a:bufid, "coquille_goal_bufid", -1) == -1
+        " Coquille was stopped for the buffer
+        return
+    endif
+    call coquille#Python('coquille.BufferState.lookup_bufid(' . a:bufid .
+                \ ').continuous_check()')
+endfunction
+
+" Call BufferState.poll() for bufid from a timer, until it returns false
+function! coquille#StartPolling(bufid)
+    if index(values(s:poll_timers), a:bufid) != -1
+        " The running timer will pick up the new commands
+        return
+    endif
+    let l:interval = g:coquille_max_fps > 0 ? 1000 / g:coquille_max_fps : 10
+    let l:timer = timer_start(max([l:interval, 10]), 'coquille#Poll',
+                \             {'repeat': -1})
+    let s:poll_timers[l:timer] = a:bufid
+endfunction
+
+function! coquille#Poll(timer)
+    let l:bufid = get(s:poll_timers, a:timer, -1)
+    if l:bufid == -1 || !coquille#PythonExpr(
+                \ 'coquille.BufferState.poll_bufid(' . l:bufid . ')')
+        call timer_stop(a:timer)
+        if has_key(s:poll_timers, a:timer)
+            call remove(s:poll_timers, a:timer)
         endif
     endif
 endfunction
@@ -821,6 +1247,13 @@ function! coquille#WindowActivated(winid, hint_tabnr, hint_winnr)
         let s:active_goal_winid = l:goal_winid
         let s:active_info_winid = l:info_winid
     endif
+    let l:bufid = coquille#TabWinBufnr(l:tabwin[0], l:tabwin[1])
+    if (g:coquille_max_sessions > 0 || g:coquille_max_session_memory > 0) &&
+                \ getbufvar(l:bufid, "coquille_goal_bufid", -1) != -1
+        " Resume the buffer if it was suspended, and count it as used
+        call coquille#Python('coquille.BufferState.lookup_bufid(' .
+                    \ l:bufid . ').activate()')
+    endif
     call coquille#UpdateSupportingWindows(a:winid, l:tabwin[0], l:tabwin[1])
     call coquille#SyncWindowColors(a:winid, l:tabwin[0], l:tabwin[1])
 endfunction
@@ -839,6 +1272,7 @@ function! coquille#EnsureLaunched(winid, ...)
         hi default CoqWarning ctermbg=220 guibg=gold
     endif
     hi link CoqError Error
+    hi default link CoqSlow Todo
 
     let l:tabwin = coquille#WinId2TabWin(a:winid, tabpagenr(), winnr())
     let l:bufid = coquille#TabWinBufnr(l:tabwin[0], l:tabwin[1])
@@ -881,7 +1315,7 @@ function! coquille#CoqRewind()
     let l:winid = coquille#WinGetId(tabpagenr(), winnr())
     let l:bufid = coquille#EnsureLaunched(l:winid)
     call coquille#Python('coquille.BufferState.lookup_bufid(' . l:bufid . ').' .
-                \ 'coq_rewind()')
+                \ 'coq_undo()')
 endfunction
 
 function! coquille#CoqToCursor()
@@ -898,6 +1332,27 @@ function! coquille#RawQuery(...)
                 \ 'coq_raw_query(*'.  string(a:000) . ')')
 endfunction
 
+function! coquille#CoqStats(...)
+    let l:winid = coquille#WinGetId(tabpagenr(), winnr())
+    let l:bufid = coquille#EnsureLaunched(l:winid)
+    call coquille#Python('coquille.BufferState.lookup_bufid(' . l:bufid . ').' .
+                \ 'show_stats(*'.  string(map(copy(a:000), 'expand(v:val)')) . ')')
+endfunction
+
+function! coquille#CoqProfile(...)
+    let l:winid = coquille#WinGetId(tabpagenr(), winnr())
+    let l:bufid = coquille#EnsureLaunched(l:winid)
+    call coquille#Python('coquille.BufferState.lookup_bufid(' . l:bufid . ').' .
+                \ 'show_profile(*'.  string(a:000) . ')')
+endfunction
+
+" Show the sentences in b:coquille_profile of bufid in the location list
+function! coquille#ShowProfile(bufid)
+    call setloclist(0, getbufvar(a:bufid, "coquille_profile"))
+    call setbufvar(a:bufid, "coquille_profile", [])
+    lopen
+endfunction
+
 function! coquille#Register()
     let b:checked = -1
     let b:sent    = -1
@@ -911,6 +1366,8 @@ function! coquille#Register()
     command! -buffer CoqKill call coquille#KillSession()
 
     command! -buffer -nargs=* Coq call coquille#RawQuery(<f-args>)
+    command! -buffer -nargs=? -complete=file CoqStats call coquille#CoqStats(<f-args>)
+    command! -buffer -nargs=? CoqProfile call coquille#CoqProfile(<f-args>)
 
     command! -bar -buffer -nargs=* -complete=file CoqLaunch call coquille#Launch(<f-args>)
 
@@ -0,0 +1,48 @@
+# Computes small sets of line edits between two versions of a buffer, so that
+# vim buffers can be updated without rewriting every line.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import difflib
+
+def line_edits(old, new):
+    """
+    Returns a list of (start, stop, lines) edits that turn the list of lines
+    [old] into [new] when applied in order with buf[start:stop] = lines. The
+    edits are sorted from the end of the buffer to the start, so applying one
+    does not move the lines of the following ones.
+    """
+    # Most updates only touch the middle of the buffer, so strip the common
+    # prefix and suffix before running the (quadratic) matcher.
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while (suffix < limit and
+           old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]):
+        suffix += 1
+    old_mid = old[prefix:len(old) - suffix]
+    new_mid = new[prefix:len(new) - suffix]
+    if not old_mid or not new_mid:
+        if not old_mid and not new_mid:
+            return []
+        return [(prefix, prefix + len(old_mid), new_mid)]
+    matcher = difflib.SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+    edits = []
+    for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+        if tag != 'equal':
+            edits.append((prefix + i1, prefix + i2, new_mid[j1:j2]))
+    edits.reverse()
+    return edits
+
+def edit_cost(edits):
+    "Returns the number of lines deleted or written by the edits"
+    return sum((stop - start) + len(lines) for (start, stop, lines) in edits)
+
+def apply_line_edits(buf, edits):
+    for (start, stop, lines) in edits:
+        buf[start:stop] = lines
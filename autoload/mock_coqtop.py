@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# A stand-in for `coqtop -ideslave` that speaks enough of the XML protocol to
+# drive coqtop.CoqTop without a Coq install. It does not check anything: every
+# sentence is accepted, unless it contains the --fail-on string. Sentences
+# containing the --fail-goal-on string are accepted, but fail once Goal checks
+# them. Like coqtop, Edit_at drops the states after its target, unless
+# --edit-forward is given.
+#
+# Supported calls: Init, Add, Edit_at, Goal, Query. Every accepted Add is
+# followed by processingin and processed state feedback, and optionally by
+# message feedback. The coqtop arguments that CoqTop passes are ignored, so it
+# can be launched with:
+#
+#   coq_top.coqtop_command = [sys.executable, "mock_coqtop.py", "--latency",
+#                             "0.01"]
+#   coq_top.restart_coq()
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import argparse
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import coqtop as CT
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds to wait before answering each call")
+    parser.add_argument("--messages", type=int, default=0,
+                        help="Message feedbacks to send after each Add")
+    parser.add_argument("--message-size", type=int, default=40,
+                        help="Length of each feedback message")
+    parser.add_argument("--goals", type=int, default=1,
+                        help="Number of goals returned by Goal")
+    parser.add_argument("--hyps", type=int, default=3,
+                        help="Number of hypotheses in the first goal")
+    parser.add_argument("--hyp-size", type=int, default=20,
+                        help="Length of each hypothesis")
+    parser.add_argument("--fail-on", default=None,
+                        help="Reject the Add of sentences containing this")
+    parser.add_argument("--fail-goal-on", default=None,
+                        help="Fail the Goal of states after a sentence "
+                             "containing this")
+    parser.add_argument("--edit-forward", action="store_true",
+                        help="Keep the states after an Edit_at target, so "
+                             "that Edit_at can go forward to them")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of proof workers to report")
+    # Ignore the coqtop arguments
+    return parser.parse_known_args(argv)[0]
+
+def richpp(text):
+    elt = CT.build('_')
+    elt.text = text
+    return CT.build('richpp', None, [elt])
+
+def good(val):
+    return CT.build('value', 'good', [CT.encode_value(val)])
+
+def fail(revert_state, msg, loc=None):
+    xml = CT.build('value', 'fail', [CT.encode_value(revert_state),
+                                     richpp(msg)])
+    if loc is not None:
+        xml.set('loc_s', str(loc[0]))
+        xml.set('loc_e', str(loc[1]))
+    return xml
+
+def feedback(state_id, content_type, children=(), obj="state"):
+    if obj == "state":
+        ident = CT.encode_value(state_id)
+    else:
+        ident = CT.encode_value(CT.EditId(state_id))
+    content = CT.build('feedback_content', content_type, children)
+    xml = CT.build('feedback', None, [ident, content])
+    xml.set('object', obj)
+    xml.set('route', '0')
+    return xml
+
+def message(level, text):
+    return CT.build('message', None, [CT.build('message_level', level),
+                                      CT.build('option', 'none'),
+                                      richpp(text)])
+
+class MockCoqtop(object):
+    def __init__(self, args, out):
+        self.args = args
+        self.out = out
+        # The state ids from the root to the tip
+        self.states = []
+        # Maps the state ids to their parent. With --edit-forward, it keeps
+        # the states that Edit_at went back from.
+        self.parents = {}
+        # Maps the state ids to the text of the sentence that created them
+        self.texts = {}
+        self.next_state = 1
+        self.calls = 0
+
+    def write(self, *elts):
+        self.out.write(b''.join(ET.tostring(e, 'utf-8') for e in elts))
+        self.out.flush()
+
+    def worker(self, state_id):
+        return "proofworker:%d" % (state_id.id % self.args.workers)
+
+    def new_state(self):
+        state_id = CT.StateId(self.next_state)
+        self.next_state += 1
+        self.parents[state_id] = self.states[-1] if self.states else None
+        self.states.append(state_id)
+        return state_id
+
+    def handle(self, call):
+        name = call.get('val')
+        arg = CT.parse_value(call[0])
+        self.calls += 1
+        if self.args.latency:
+            time.sleep(self.args.latency)
+        handler = getattr(self, "call_" + name, None)
+        if handler is None:
+            self.write(fail(CT.StateId(0), "mock coqtop: unknown call " + name))
+        else:
+            handler(arg)
+
+    def call_Init(self, arg):
+        self.states = []
+        self.write(good(self.new_state()))
+
+    def call_Add(self, arg):
+        ((cmd, edit), (parent, verbose)) = arg
+        if parent != self.states[-1]:
+            self.write(fail(self.states[-1], "mock coqtop: bad parent state"))
+            return
+        if self.args.fail_on is not None and self.args.fail_on in cmd:
+            self.write(feedback(edit, 'message',
+                                [message('error', "Syntax error")],
+                                obj="edit"),
+                       fail(parent, "Syntax error",
+                            (0, len(cmd.encode('utf-8')))))
+            return
+        state_id = self.new_state()
+        self.texts[state_id] = cmd
+        self.write(good((state_id, (CT.Inl(()), ""))))
+        worker = self.worker(state_id)
+        elts = [feedback(state_id, 'processingin', [CT.encode_value(worker)])]
+        text = ("x" * self.args.message_size)
+        for i in range(self.args.messages):
+            elts.append(feedback(state_id, 'message',
+                                 [message('info', text)]))
+        elts.append(feedback(state_id, 'processed'))
+        elts.append(feedback(state_id, 'workerstatus',
+                             [CT.encode_value((worker, "Idle"))]))
+        self.write(*elts)
+
+    def call_Edit_at(self, state_id):
+        if state_id not in self.parents:
+            self.write(fail(self.states[-1], "mock coqtop: unknown state"))
+            return
+        if not self.args.edit_forward:
+            for dropped in self.states[self.states.index(state_id) + 1:]:
+                del self.parents[dropped]
+        self.states = []
+        while state_id is not None:
+            self.states.insert(0, state_id)
+            state_id = self.parents[state_id]
+        self.write(good(CT.Inl(())))
+
+    def call_Goal(self, arg):
+        if self.args.fail_goal_on is not None:
+            for state_id in self.states:
+                if self.args.fail_goal_on in self.texts.get(state_id, ""):
+                    self.write(feedback(state_id, 'message',
+                                        [message('error', "Error")]),
+                               fail(self.parents[state_id], "Error"))
+                    return
+        if len(self.states) <= 1:
+            self.write(good(CT.Option(None)))
+            return
+        hyp = "H : " + "h" * max(self.args.hyp_size - 4, 0)
+        goals = []
+        for i in range(self.args.goals):
+            hyps = [hyp] * self.args.hyps if i == 0 else []
+            goals.append(CT.build('goal', None, [
+                CT.encode_value(str(i + 1)),
+                CT.build('list', None, [richpp(h) for h in hyps]),
+                richpp("goal %d at state %d" % (i + 1,
+                                                self.states[-1].id))]))
+        xml = CT.build('goals', None, [CT.build('list', None, goals),
+                                        CT.build('list'),
+                                        CT.build('list'),
+                                        CT.build('list')])
+        self.write(CT.build('value', 'good',
+                            [CT.build('option', 'some', [xml])]))
+
+    def call_Query(self, arg):
+        (query, state_id) = arg
+        self.write(feedback(state_id, 'message',
+                            [message('notice', "Query: " + query)]),
+                   good(""))
+
+def main(argv):
+    args = parse_args(argv)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    mock = MockCoqtop(args, out)
+    decoder = CT.XmlStreamDecoder()
+    fd = sys.stdin.fileno()
+    while True:
+        data = os.read(fd, 0x4000)
+        if not data:
+            break
+        decoder.feed(data)
+        for call in decoder.pop_elements():
+            mock.handle(call)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+# Merges the UI work requested while coqtop is busy, so the screen is redrawn
+# at most max_fps times per second instead of once per feedback.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import time
+
+class RedrawScheduler(object):
+    def __init__(self, max_fps, clock=time.time):
+        # A max_fps of 0 or less flushes every time
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.clock = clock
+        # CoqTop result bits waiting to be handled
+        self.pending = 0
+        # The time of the last flush
+        self.last_flush = None
+
+    def add(self, result):
+        "Merges the result bits from CoqTop.wait_for_result"
+        self.pending |= result
+
+    def due(self):
+        "Returns True if the pending work should be flushed now"
+        return self.pending != 0 and self.timeout() == 0
+
+    def timeout(self):
+        """
+        Returns how many seconds to wait before the pending work is due, or
+        None if nothing is pending.
+        """
+        if self.pending == 0:
+            return None
+        if self.last_flush is None:
+            return 0
+        return max(0, self.last_flush + self.interval - self.clock())
+
+    def take(self):
+        "Returns the pending work and starts a new frame"
+        pending = self.pending
+        self.pending = 0
+        self.last_flush = self.clock()
+        return pending
@@ -0,0 +1,245 @@
+# Splits the contents of a coq source buffer into sentences.
+#
+# The buffer can be anything that supports len() and indexing by line number,
+# and returns the lines as utf-8 bytes or unicode strings: a vim buffer, or a
+# plain list of lines.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import re
+
+from bisect import bisect_left
+
+# Define unicode in python 3
+if isinstance(__builtins__, dict):
+    unicode = __builtins__.get('unicode', str)
+else:
+    unicode = getattr(__builtins__, 'unicode', str)
+
+def _decode(line_val):
+    if not isinstance(line_val, unicode):
+        line_val = line_val.decode("utf-8")
+    return line_val
+
+# A bullet is:
+# - One or more '-'
+# - One or more '+'
+# - One or more '*'
+# - Exactly 1 '{' (additional ones are parsed as separate statements)
+# - Exactly 1 '}' (additional ones are parsed as separate statements)
+bullets = re.compile(r"-+|\++|\*+|{|}")
+
+# Tokens that matter outside of comments and strings
+code_tokens = re.compile(r'\.|\(\*|"')
+# Tokens that matter inside of a comment
+comment_tokens = re.compile(r'\(\*|\*\)')
+
+# Lexer states for [find_next_chunk]
+#
+# Skipping the blanks and comments before the start of the chunk
+START = 0
+# Inside the chunk, looking for the terminating dot
+CODE = 1
+# Inside a (possibly nested) comment
+COMMENT = 2
+# Inside a string
+STRING = 3
+
+def find_next_chunk(buf, line, col):
+    """
+    Returns the position of the next chunk dot after a certain position.
+    That can either be a bullet if we are in a proof, or "a string" terminated
+    by a dot (outside of a comment, and not denoting a path).
+
+    The returned position is one column after the end of the chunk, or None
+    if the buffer ends first. The buffer is scanned once, and every line is
+    decoded at most once.
+    """
+    blen = len(buf)
+    state = START
+    # The state to go back to at the end of a comment
+    after_comment = START
+    comment_depth = 0
+    line_val = None
+    while line < blen:
+        if line_val is None:
+            line_val = _decode(buf[line])
+
+        if state == START:
+            # We start by striping all whitespaces (including \n) from the
+            # beginning of the chunk.
+            while col < len(line_val) and line_val[col] in (' ', '\t'):
+                col += 1
+            if col >= len(line_val):
+                line += 1
+                col = 0
+                line_val = None
+                continue
+            # Then we check if the first character of the chunk is a bullet.
+            # The bullet chars can never be used at the *beginning* of a
+            # chunk outside of a proof, so there is no need to check whether
+            # we are in a proof.
+            bullet_match = bullets.match(line_val, col)
+            if bullet_match:
+                return (line, bullet_match.end())
+            # We might have a commentary before the bullet, we should be
+            # skiping it and keep on looking.
+            if line_val.startswith('(*', col):
+                state = COMMENT
+                after_comment = START
+                comment_depth = 1
+                col += 2
+            else:
+                # If the chunk doesn't start with a bullet, we look for a dot.
+                state = CODE
+
+        elif state == CODE:
+            match = code_tokens.search(line_val, col)
+            if match is None:
+                # Nothing on this line
+                line += 1
+                col = 0
+                line_val = None
+                continue
+            token = match.group()
+            pos = match.start()
+            col = match.end()
+            if token == '(*':
+                state = COMMENT
+                after_comment = CODE
+                comment_depth = 1
+            elif token == '"':
+                state = STRING
+            elif pos < len(line_val) - 1 and line_val[pos + 1] != ' ':
+                # Sometimes dot are used to access module fields, we don't
+                # want to stop just after the module name.
+                # Example: [Require Import Coq.Arith]
+                pass
+            elif pos > 0 and line_val[pos - 1] == '.':
+                # We don't want to capture "..", but we want to capture "..."
+                if pos > 1 and line_val[pos - 2] == '.':
+                    return (line, col)
+            else:
+                return (line, col)
+
+        elif state == COMMENT:
+            match = comment_tokens.search(line_val, col)
+            if match is None:
+                line += 1
+                col = 0
+                line_val = None
+                continue
+            col = match.end()
+            if match.group() == '(*':
+                comment_depth += 1
+            else:
+                comment_depth -= 1
+                if comment_depth == 0:
+                    state = after_comment
+
+        else:
+            # STRING
+            str_end = line_val.find('"', col)
+            if str_end == -1:
+                line += 1
+                col = 0
+                line_val = None
+                continue
+            col = str_end + 1
+            state = CODE
+
+    return None
+
+# Tokens that matter to [normalize]
+normalize_tokens = re.compile(r'\(\*|\*\)|"|\s+')
+
+def normalize(text):
+    """
+    Returns [text] without its comments, and with each run of blanks replaced
+    by a single space, so that two sentences that only differ by their layout
+    compare equal. Strings are kept as they are.
+    """
+    parts = []
+    # The start of the text that is not in parts yet
+    last = 0
+    comment_depth = 0
+    in_string = False
+    for match in normalize_tokens.finditer(text):
+        token = match.group()
+        if in_string:
+            if token == '"':
+                in_string = False
+        elif comment_depth > 0:
+            if token == '(*':
+                comment_depth += 1
+            elif token == '*)':
+                comment_depth -= 1
+                if comment_depth == 0:
+                    last = match.end()
+        elif token == '"':
+            in_string = True
+        elif token != '*)':
+            # A comment or blanks separate the text around them
+            parts.append(text[last:match.start()])
+            parts.append(' ')
+            if token == '(*':
+                comment_depth = 1
+            else:
+                last = match.end()
+    if comment_depth == 0:
+        parts.append(text[last:])
+    # Merge the separators that ended up next to each other
+    result = []
+    for part in parts:
+        if part == ' ' and result and result[-1] == ' ':
+            continue
+        if part:
+            result.append(part)
+    return ''.join(result).strip()
+
+class SentenceIndex(object):
+    """
+    Caches the sentence end positions of a buffer, so that stepping through
+    the buffer does not lex the same text twice.
+
+    [ends] is the chain of (line, col) positions found by [find_next_chunk]
+    starting at the beginning of the buffer:
+    ends[i + 1] == find_next_chunk(buf, *ends[i]). A sentence can only end
+    outside of comments and strings, so the lexer state at each of these
+    positions is always the initial one and does not need to be stored.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.ends = [(0, 0)]
+        # True when the last position in [ends] has no sentence after it
+        self.complete = False
+
+    def invalidate(self, line):
+        """
+        Forgets the sentences that end on or after [line], because the buffer
+        changed starting at that 0-based line.
+        """
+        idx = bisect_left(self.ends, (line, 0))
+        del self.ends[max(idx, 1):]
+        self.complete = False
+
+    def next_end(self, line, col):
+        "Same as [find_next_chunk], but answered from the cache when possible"
+        pos = (line, col)
+        idx = bisect_left(self.ends, pos)
+        if idx == len(self.ends) or self.ends[idx] != pos:
+            # Not a known sentence boundary
+            return find_next_chunk(self.buf, line, col)
+        if idx + 1 < len(self.ends):
+            return self.ends[idx + 1]
+        if self.complete:
+            return None
+        end = find_next_chunk(self.buf, line, col)
+        if end is None:
+            self.complete = True
+        else:
+            self.ends.append(end)
+        return end
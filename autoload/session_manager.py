@@ -0,0 +1,64 @@
+# Limits the number of coqtop processes running at once, for vims with many
+# coq buffers open.
+#
+# Each session (a BufferState) is touched when it is used. Once too many
+# sessions run coqtop, or their coqtop processes use too much memory, the
+# least recently used sessions are suspended: their coqtop is stopped, and
+# they replay their commands when they are used again.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from collections import OrderedDict
+
+import coqtop_pool
+
+class SessionManager(object):
+    def __init__(self, max_sessions=0, max_memory=0,
+                 memory=coqtop_pool.process_memory):
+        # The most sessions that run coqtop at once. 0 is no limit.
+        self.max_sessions = max_sessions
+        # The most bytes of memory the coqtop processes use. 0 is no limit.
+        self.max_memory = max_memory
+        # memory(process) returns the bytes used by a coqtop process
+        self.memory = memory
+        # The sessions, least recently used first. A session has a coq_top,
+        # and a suspend() method that stops its coqtop process.
+        self.sessions = OrderedDict()
+
+    def touch(self, session):
+        """
+        Marks session as the most recently used one, then suspends the least
+        recently used sessions that are over the limits.
+        """
+        self.sessions.pop(id(session), None)
+        self.sessions[id(session)] = session
+        self.enforce()
+
+    def forget(self, session):
+        self.sessions.pop(id(session), None)
+
+    def running(self):
+        "Returns the sessions that run coqtop, least recently used first"
+        return [s for s in self.sessions.values()
+                if s.coq_top.coqtop is not None]
+
+    def enforce(self):
+        running = self.running()
+        # The most recently used session is never suspended
+        candidates = [s for s in running[:-1]
+                      if not s.coq_top.is_sending()]
+        used = 0
+        if self.max_memory > 0:
+            used = sum(self.memory(s.coq_top.coqtop) for s in running)
+        count = len(running)
+        for session in candidates:
+            over_count = self.max_sessions > 0 and count > self.max_sessions
+            over_memory = self.max_memory > 0 and used > self.max_memory
+            if not over_count and not over_memory:
+                break
+            if over_memory:
+                used -= self.memory(session.coq_top.coqtop)
+            session.suspend()
+            count -= 1
@@ -1,20 +1,26 @@
+from __future__ import unicode_literals
+from __future__ import division
+
 from coqtop import *
 
-def get_goals():
-    r = goals()
-    if r is None:
-        return r
-    if isinstance(r, Err):
-        return r
+import os
+import sys
 
-    if r.msg is not None:
-        r.msg
+mock_coqtop = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "mock_coqtop.py")
 
-    if r.val.val is None:
-        return "no goals"
+def launch_mock(*mock_args):
+    "Returns a CoqTop connected to a mock_coqtop.py process"
+    ct = CoqTop()
+    ct.coqtop_command = [sys.executable, mock_coqtop] + list(mock_args)
+    assert ct.restart_coq()
+    return ct
 
-    gs = r.val.val
-    return gs
+def get_goals(ct):
+    r = ct.goals(None)
+    if r is None or r.val is None:
+        return "no goals"
+    return r.val
 
 
 cmd1 = "Theorem plus_0_r : forall n : nat, n + 0 = n."
@@ -29,50 +35,600 @@ cmd9 = "Qed."
 
 
 def test_proof():
-    global states
-    launch_coq()
-
-    advance(cmd1)
-    assert get_goals() == Goals([Goal('2', [], 'forall n : nat, n + 0 = n')], [], [], [])
-    advance(cmd2)
-    assert get_goals() == Goals([Goal('2', [], 'forall n : nat, n + 0 = n')], [], [], [])
-    advance(cmd3)
-    assert get_goals() == Goals([Goal('3', ['n : nat'], 'n + 0 = n')], [], [], [])
-    advance(cmd4)
-    assert get_goals() == Goals([Goal('7', [], '0 + 0 = 0'), Goal('10', ["n' : nat", "IHn' : n' + 0 = n'"], "S n' + 0 = S n'")], [], [], [])
-    advance(cmd5)
-    assert get_goals() == Goals([Goal('10', ["n' : nat", "IHn' : n' + 0 = n'"], "S n' + 0 = S n'")], [], [], [])
-    advance(cmd6)
-    assert get_goals() == Goals([Goal('13', ["n' : nat", "IHn' : n' + 0 = n'"], "S (n' + 0) = S n'")], [], [], [])
-    advance(cmd7)
-    assert get_goals() == Goals([Goal('14', ["n' : nat", "IHn' : n' + 0 = n'"], "S n' = S n'")], [], [], [])
-    advance(cmd8)
-    assert get_goals() == Goals([], [], [], [])
-    advance(cmd9)
-    assert get_goals() == "no goals"
-
-    assert states == [StateId(1), StateId(2), StateId(3), StateId(4), StateId(5), StateId(6), StateId(7), StateId(8), StateId(9)]
-
-    rewind()
-    assert get_goals() == Goals([], [], [], [])
-    rewind()
-    assert get_goals() == Goals([Goal('14', ["n' : nat", "IHn' : n' + 0 = n'"], "S n' = S n'")], [], [], [])
-    rewind()
-    assert get_goals() == Goals([Goal('13', ["n' : nat", "IHn' : n' + 0 = n'"], "S (n' + 0) = S n'")], [], [], [])
-
-    assert read_states() == [StateId(1), StateId(2), StateId(3), StateId(4), StateId(5), StateId(6)]
-    assert cur_state() == StateId(7)
-
-    advance(cmd7)
-    assert get_goals() == Goals([Goal('14', ["n' : nat", "IHn' : n' + 0 = n'"], "S n' = S n'")], [], [], [])
-    advance(cmd8)
-    assert get_goals() == Goals([], [], [], [])
-    advance(cmd9)
-    assert get_goals() == "no goals"
-
-    assert read_states() == [StateId(1), StateId(2), StateId(3), StateId(4), StateId(5), StateId(6), StateId(7), StateId(11), StateId(12)]
-
-    assert query("Print plus_0_r.") == Ok('', "plus_0_r = \nfun n : nat =>\nnat_ind (fun n0 : nat => n0 + 0 = n0) eq_refl\n  (fun (n' : nat) (IHn' : n' + 0 = n') =>\n   eq_ind_r (fun n0 : nat => S n0 = S n') eq_refl IHn') n\n     : forall n : nat, n + 0 = n\n\nArgument scope is [nat_scope]")
-    assert query("Check plus_0_r.") == Ok('', 'plus_0_r\n     : forall n : nat, n + 0 = n')
-
-    kill_coqtop()
+    ct = launch_mock("--hyps", "1")
+    assert get_goals(ct) == "no goals"
+
+    for i, cmd in enumerate([cmd1, cmd2, cmd3, cmd4, cmd5, cmd6, cmd7, cmd8,
+                             cmd9]):
+        assert isinstance(ct.advance(cmd, (i, len(cmd), len(cmd))), Ok)
+    assert [c.state_id for c in ct.get_active_commands()] == \
+            [StateId(i) for i in range(1, 11)]
+    assert get_goals(ct) == Goals([Goal('1', ['H : hhhhhhhhhhhhhhhh'],
+                                        'goal 1 at state 10')], [], [], [])
+    # The mock sends a processed feedback after each Add reply
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    assert all(c.state == Command.PROCESSED for c in ct.get_commands())
+
+    assert isinstance(ct.rewind(3), Ok)
+    assert ct.cur_state() == StateId(7)
+    assert get_goals(ct).fg[0].ccl == 'goal 1 at state 7'
+
+    assert isinstance(ct.advance(cmd7, (6, 1, 1)), Ok)
+    assert ct.cur_state() == StateId(11)
+
+    assert ct.query("Check plus_0_r.") == Ok("", "Query: Check plus_0_r.")
+    assert "Query: Check plus_0_r." in ct.get_messages()
+
+    ct.kill_coqtop()
+    assert ct.get_commands() == []
+
+def test_failed_add():
+    ct = launch_mock("--fail-on", "oops")
+    assert isinstance(ct.advance(cmd1, (0, 1, 1)), Ok)
+    r = ct.advance("oops.", (1, 5, 5))
+    assert isinstance(r, Err)
+    assert ct.get_active_command_count() == 2
+    comm = ct.get_commands()[-1]
+    assert comm.state == Command.ABANDONED
+    assert comm.msg_type == Command.ERROR
+    ct.clear_messages()
+    assert len(ct.get_commands()) == 2
+    ct.kill_coqtop()
+
+def test_send_async():
+    ct = launch_mock("--fail-on", "oops")
+    queue = [(cmd, (i, 1, 1)) for i, cmd in
+             enumerate([cmd1, cmd2, cmd3, "oops.", cmd5])]
+    ct.send_async(queue)
+    while not ct.wait_for_result() & CoqTop.SEND_DONE:
+        pass
+    ct.finish_send()
+    # Stops at the first error
+    assert ct.get_active_command_count() == 4
+    ct.kill_coqtop()
+
+def test_xml_stream_decoder():
+    decoder = XmlStreamDecoder()
+    stream = ('<feedback object="state" route="0"><state_id val="1"/>'
+              '<feedback_content val="processed"/></feedback>'
+              '<value val="good"><string>a&nbsp;b \u00e9</string></value>'
+              ).encode('utf-8')
+    elts = []
+    # Feed one byte at a time to split tags, entities and utf-8 sequences.
+    for i in range(len(stream)):
+        decoder.feed(stream[i:i + 1])
+        elts.extend(decoder.pop_elements())
+    assert [e.tag for e in elts] == ['feedback', 'value']
+    assert parse_response(elts[1]) == Ok('a b \u00e9', None)
+    assert decoder.bytes_parsed == len(stream)
+    assert decoder.elements_parsed == 2
+
+def test_command_indexes():
+    ct = CoqTop()
+    with ct.lock:
+        root = Command((0, 0, 0))
+        root.edit_id = None
+        root.state_id = StateId(1)
+        ct.append_command(root)
+        for i in range(1, 4):
+            comm = Command((i, 5, 5))
+            ct.append_command(comm)
+            ct.set_state_id(comm, StateId(i + 1))
+        ct.reverted_index = len(ct.states)
+        ct.check_state_indexes()
+    assert ct.get_command_by_state_id(StateId(3)) is ct.states[2]
+    assert ct.get_command_by_edit(ct.states[3].edit_id) is ct.states[3]
+    assert ct.count_active_commands_until(2, 4) == 2
+    assert ct.count_active_commands_until(2, 5) == 3
+    with ct.lock:
+        ct.reverted_index = 2
+        ct.truncate_commands(2)
+        ct.check_state_indexes()
+    assert ct.get_command_by_state_id(StateId(3)) is None
+    assert ct.count_active_commands_until(10, 0) == 2
+
+sentence_buf = [
+    "Require Import Coq.Arith.PeanoNat.",
+    "(* A comment. (* Nested. *) *)",
+    "Theorem t : True.",
+    "Proof.",
+    "  - exact I.",
+    "Qed.",
+]
+
+def test_sentence_index():
+    import sentences
+    index = sentences.SentenceIndex(sentence_buf)
+    pos = (0, 0)
+    ends = []
+    while True:
+        pos = index.next_end(*pos)
+        if pos is None:
+            break
+        ends.append(pos)
+    assert ends == [(0, 34), (2, 17), (3, 6), (4, 3), (4, 12), (5, 4)]
+    assert index.ends == [(0, 0)] + ends
+    index.invalidate(3)
+    assert index.ends == [(0, 0), (0, 34), (2, 17)]
+    assert index.next_end(2, 17) == (3, 6)
+
+def test_find_next_chunk():
+    import sentences
+    buf = ["Check a.b (* x. *) \"y.\" ..", "  z... w."]
+    assert sentences.find_next_chunk(buf, 0, 0) == (1, 6)
+    # Deeply nested and long comments must not recurse.
+    buf = ["(*"] * 5000 + ["*)"] * 5000 + ["Check " + "M." * 5000 + "x."]
+    assert sentences.find_next_chunk(buf, 0, 0) == (10000, 10008)
+
+def test_replay(tmpdir):
+    import json
+    import xml.etree.ElementTree as ET
+    import coqtop_replay
+    import mock_coqtop as MC
+    def doc(xml):
+        return ET.tostring(xml, 'utf-8').decode('utf-8')
+    def add(cmd, edit, parent):
+        return doc(encode_call('Add', ((cmd, edit), (parent, True))))
+    events = [
+        ("input", doc(encode_call('Init', Option(None)))),
+        ("output", doc(MC.good(StateId(1)))),
+        ("input", add(cmd1, -1, StateId(1))),
+        ("output", doc(MC.good((StateId(2), (Inl(()), ""))))),
+        ("output", doc(MC.feedback(StateId(2), 'processed'))),
+        ("input", add(cmd2, -2, StateId(2))),
+        ("output", doc(MC.good((StateId(3), (Inl(()), ""))))),
+        ("input", doc(encode_call('Edit_at', StateId(2)))),
+        ("output", doc(MC.good(Inl(())))),
+        ("input", doc(encode_call('Goal', ()))),
+        ("output", doc(MC.good(Option(None)))),
+    ]
+    trace = tmpdir.join("trace.jsonl")
+    lines = [json.dumps({"version": 1, "argv": ["coqtop"]})]
+    for i, (stream, data) in enumerate(events):
+        lines.append(json.dumps({"time": i * 0.001, "stream": stream,
+                                 "data": data}))
+    trace.write("\n".join(lines) + "\n")
+    timings = coqtop_replay.replay(str(trace))
+    assert sorted((name, len(t)) for name, t in timings.items()) == \
+            [("Add", 2), ("Edit_at", 1), ("Goal", 1), ("Init", 1)]
+
+def test_call_stats():
+    import call_stats
+    h = call_stats.Histogram()
+    for i in range(1, 101):
+        h.record(i / 1000)
+    assert h.count == 100
+    assert h.max == 0.1
+    # Buckets are about 9% wide
+    assert 0.050 <= h.percentile(50) <= 0.050 * 1.1
+    assert 0.090 <= h.percentile(90) <= 0.090 * 1.1
+    assert h.percentile(100) == 0.1
+
+    ct = launch_mock()
+    ct.advance(cmd1, (0, 1, 1))
+    ct.goals(None)
+    stats = ct.get_stats()
+    assert sorted(stats) == ["Add", "Goal", "Init"]
+    assert stats["Add"]["total"]["count"] == 1
+    assert "Goal" in ct.get_stats_report()
+    ct.kill_coqtop()
+
+def test_line_edits():
+    import line_diff
+    old = ["a", "b", "c", "d", "e", "f"]
+    for new in [["a", "b", "x", "d", "e", "f"],
+                ["a", "c", "d", "y", "z", "e", "f"],
+                ["x"] + old + ["y"],
+                [],
+                old]:
+        edits = line_diff.line_edits(old, new)
+        buf = list(old)
+        line_diff.apply_line_edits(buf, edits)
+        assert buf == new
+    assert line_diff.line_edits(old, old) == []
+    assert line_diff.edit_cost(
+            line_diff.line_edits(old, ["a", "b", "x", "d", "e", "f"])) == 2
+
+def test_goal_cache():
+    ct = launch_mock()
+    for i, cmd in enumerate([cmd1, cmd2, cmd3]):
+        ct.advance(cmd, (i, 1, 1))
+        ct.goals(None)
+    assert ct.get_stats()["Goal"]["total"]["count"] == 3
+    ct.rewind(1)
+    # Answered from the cache
+    assert get_goals(ct).fg[0].ccl == 'goal 1 at state 3'
+    assert ct.get_stats()["Goal"]["total"]["count"] == 3
+    # The discarded state was evicted
+    assert ct.goal_cache.get(StateId(4)) is None
+    ct.restart_coq()
+    assert ct.goal_cache.get(StateId(2)) is None
+    ct.kill_coqtop()
+
+def test_command_colors():
+    import command_colors as CC
+    ct = launch_mock("--fail-on", "oops")
+    colors = CC.CommandColors(lambda start, offset, end: start)
+    drawn = set()
+    def update(visible=None):
+        (removed, added) = colors.update(ct, visible)
+        assert drawn.issuperset(removed)
+        drawn.difference_update(removed)
+        assert drawn.isdisjoint(added)
+        drawn.update(added)
+        # Same as recoloring every command
+        expected = set()
+        commands = ct.get_commands()
+        live = True
+        for i, (prev, comm) in enumerate(zip(commands, commands[1:]), 1):
+            live = live and not CC.is_dead(comm)
+            expected.update(colors.colors(
+                comm, prev, live and (visible is None or i < visible)))
+        assert drawn == expected
+        return (removed, added)
+
+    update()
+    for i, cmd in enumerate([cmd1, cmd2, cmd3]):
+        ct.advance(cmd, (i, len(cmd), len(cmd)))
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    (removed, added) = update()
+    assert removed == []
+    assert sorted(added) == [(CC.CHECKED, ((1, 1), (1, len(cmd1) + 1))),
+                             (CC.CHECKED, ((1, len(cmd1) + 1), (2, 7))),
+                             (CC.CHECKED, ((2, 7), (3, len(cmd3) + 1)))]
+    # The commands checked ahead of the user are not colored
+    (removed, added) = update(visible=2)
+    assert added == [] and len(removed) == 2
+    (removed, added) = update()
+    assert removed == [] and len(added) == 2
+    ct.advance("oops.", (3, 5, 5))
+    (removed, added) = update()
+    assert removed == [] and [g for (g, r) in added] == [CC.ERRORS]
+    # Nothing changed
+    assert update() == ([], [])
+    ct.rewind(1)
+    update()
+    assert sorted(g for (g, r) in drawn) == [CC.CHECKED] * 2
+    ct.clear_messages()
+    update()
+    ct.kill_coqtop()
+    update()
+    assert drawn == set()
+
+def test_redraw_scheduler():
+    import redraw_scheduler
+    now = [100.0]
+    s = redraw_scheduler.RedrawScheduler(10, clock=lambda: now[0])
+    assert s.timeout() is None and not s.due()
+    s.add(CoqTop.COMMAND_CHANGED)
+    # The first frame is not delayed
+    assert s.due()
+    assert s.take() == CoqTop.COMMAND_CHANGED
+    s.add(CoqTop.COMMAND_CHANGED)
+    s.add(CoqTop.MESSAGE_RECEIVED)
+    now[0] += 0.04
+    assert not s.due()
+    assert abs(s.timeout() - 0.06) < 1e-9
+    now[0] += 0.06
+    assert s.due()
+    assert s.take() == CoqTop.COMMAND_CHANGED | CoqTop.MESSAGE_RECEIVED
+
+    ct = CoqTop()
+    assert ct.wait_for_result(0.01) == 0
+
+def test_send_async_goals():
+    ct = launch_mock("--latency", "0.01")
+    queue = [(cmd, (i, 1, 1)) for i, cmd in enumerate([cmd1, cmd2, cmd3])]
+    ct.send_async(queue, fetch_goals=True)
+    result = 0
+    while not result & CoqTop.SEND_DONE:
+        result |= ct.wait_for_result()
+    ct.finish_send()
+    assert result & CoqTop.GOALS_READY
+    assert ct.take_goals().val.fg[0].ccl == 'goal 1 at state 4'
+    assert not ct.has_unchecked_commands()
+    # Cancelling stops after the Add in progress
+    ct.send_async([(cmd4, (i + 3, 1, 1)) for i in range(50)],
+                  fetch_goals=True)
+    ct.cancel_send()
+    ct.finish_send()
+    assert ct.get_active_command_count() in (4, 5)
+    assert ct.take_goals() is None
+    ct.kill_coqtop()
+
+def test_reader_thread():
+    import time
+    ct = launch_mock("--messages", "1")
+    ct.advance(cmd1, (0, 1, 1))
+    # The feedback sent after the answer is applied without another call
+    deadline = time.time() + 5
+    while ct.has_unchecked_commands() and time.time() < deadline:
+        time.sleep(0.001)
+    assert not ct.has_unchecked_commands()
+    assert ct.wait_for_result(5) & CoqTop.MESSAGE_RECEIVED
+    assert ct.get_messages() == "x" * 40
+    ct.kill_coqtop()
+    while True:
+        r = ct.process_response(0)
+        if r is not None:
+            break
+    assert r == Err("coq died", 0, None, None)
+
+def test_message_log():
+    log = MessageLog(3)
+    for m in "abcde":
+        log.append(m)
+    assert list(log) == ["c", "d", "e"]
+    assert log.since(3) == ["d", "e"]
+    # Messages that were dropped are skipped
+    assert log.since(0) == ["c", "d", "e"]
+    assert log.since(5) == []
+    ct = launch_mock("--messages", "1")
+    (seq, epoch, reset, msgs) = ct.get_new_messages(0, None)
+    assert reset and msgs == []
+    ct.advance(cmd1, (0, 1, 1))
+    while not ct.wait_for_result(5) & CoqTop.MESSAGE_RECEIVED:
+        pass
+    (seq, epoch, reset, msgs) = ct.get_new_messages(seq, epoch)
+    assert not reset and msgs == ["x" * 40]
+    assert ct.get_new_messages(seq, epoch) == (seq, epoch, False, [])
+    ct.clear_messages()
+    assert ct.get_new_messages(seq, epoch)[2]
+    ct.kill_coqtop()
+
+def test_coqtop_pool():
+    import time
+    import coqtop_pool
+    pool = coqtop_pool.CoqtopPool(1)
+    ct = CoqTop()
+    ct.coqtop_command = [sys.executable, mock_coqtop]
+    ct.pool = pool
+    # Nothing is ready for the first launch, but it fills the pool
+    assert ct.restart_coq()
+    key = (os.getcwd(),) + tuple(ct.coqtop_command)
+    deadline = time.time() + 5
+    while not pool.idle.get(key) and time.time() < deadline:
+        time.sleep(0.01)
+    warm = pool.idle[key][0]
+    assert ct.restart_coq()
+    assert ct.coqtop is warm.process
+    assert ct.cur_state() == warm.state_id
+    # A process started elsewhere would resolve relative paths wrongly
+    other = os.path.dirname(os.getcwd())
+    assert pool.take(ct.coqtop_command, [], other) is None
+    ct.advance(cmd1, (0, 1, 1))
+    assert get_goals(ct).fg[0].ccl == 'goal 1 at state 2'
+    ct.kill_coqtop()
+    pool.close()
+    assert not pool.idle[key]
+
+def test_init_coqtop():
+    import io
+    import xml.etree.ElementTree as ET
+    import coqtop_pool
+    import mock_coqtop as M
+    class FakeProcess(object):
+        def __init__(self, fd):
+            self.stdin = io.BytesIO()
+            self.stdout = os.fdopen(fd, 'rb')
+    (r, w) = os.pipe()
+    # The answer and some feedback arrive in the same read
+    os.write(w, ET.tostring(M.good(StateId(1)), 'utf-8') +
+                ET.tostring(M.feedback(StateId(1), 'processed'), 'utf-8'))
+    process = FakeProcess(r)
+    decoder = XmlStreamDecoder()
+    assert coqtop_pool.init_coqtop(process, decoder) == StateId(1)
+    assert [e.tag for e in decoder.pop_elements()] == ['feedback']
+    os.close(w)
+    process.stdout.close()
+
+def test_session_manager():
+    import session_manager
+
+    class FakeSession(object):
+        def __init__(self):
+            self.coq_top = launch_mock()
+
+        def suspend(self):
+            self.coq_top.kill_coqtop()
+
+    sessions = [FakeSession() for i in range(3)]
+    manager = session_manager.SessionManager(
+            max_sessions=2, memory=lambda process: 100)
+    for s in sessions:
+        manager.touch(s)
+    # The least recently used session was suspended
+    assert sessions[0].coq_top.coqtop is None
+    assert manager.running() == sessions[1:]
+    manager.max_sessions = 0
+    manager.max_memory = 150
+    manager.touch(sessions[1])
+    assert manager.running() == [sessions[1]]
+    for s in sessions:
+        s.coq_top.kill_coqtop()
+
+def test_revive():
+    from sentences import normalize
+    ct = launch_mock("--edit-forward")
+    def send(cmds):
+        first = ct.get_active_command_count() - 1
+        ct.send_async([(cmd, (first + i, 1, 1)) for i, cmd in
+                       enumerate(cmds)])
+        while not ct.wait_for_result() & CoqTop.SEND_DONE:
+            pass
+        ct.finish_send()
+    send([cmd1, cmd2, cmd3])
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    states = [c.state_id for c in ct.get_active_commands()]
+    ct.rewind(2, keep_states=True)
+    ct.clear_messages()
+    # The unchanged commands go back to their states without an Add
+    send([cmd2, cmd3])
+    assert [c.state_id for c in ct.get_active_commands()] == states
+    assert ct.get_stats()["Add"]["total"]["count"] == 3
+    assert get_goals(ct).fg[0].ccl == 'goal 1 at state %d' % states[-1].id
+    # A changed command is added again, and drops the later states
+    ct.rewind(2, keep_states=True)
+    send([cmd4, cmd3])
+    assert ct.get_stats()["Add"]["total"]["count"] == 5
+    assert len(ct.get_commands()) == 4
+    # So is a command whose text only has the same hash
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    ct.rewind(1, keep_states=True)
+    ct.get_commands()[-1].text_hash = hash(normalize(cmd2))
+    send([cmd2])
+    assert ct.get_stats()["Add"]["total"]["count"] == 6
+    ct.kill_coqtop()
+
+def test_revive_fallback():
+    # Like coqtop, the mock drops the states after an Edit_at target
+    ct = launch_mock()
+    def send(cmds):
+        first = ct.get_active_command_count() - 1
+        ct.send_async([(cmd, (first + i, 1, 1)) for i, cmd in
+                       enumerate(cmds)])
+        while not ct.wait_for_result() & CoqTop.SEND_DONE:
+            pass
+        ct.finish_send()
+        while ct.has_unchecked_commands():
+            ct.process_response()
+    send([cmd1, cmd2, cmd3])
+    ct.rewind(2, keep_states=True)
+    # The Edit_at forward fails, and the commands are added again
+    send([cmd2, cmd3])
+    assert ct.edit_forward is False
+    assert ct.get_stats()["Add"]["total"]["count"] == 5
+    assert ct.get_stats()["Edit_at"]["total"]["count"] == 2
+    assert len(ct.get_commands()) == 4
+    state = ct.get_last_active_command().state_id
+    assert get_goals(ct).fg[0].ccl == 'goal 1 at state %d' % state.id
+    # It is not tried again
+    ct.rewind(2, keep_states=True)
+    send([cmd2, cmd3])
+    assert ct.get_stats()["Add"]["total"]["count"] == 7
+    assert ct.get_stats()["Edit_at"]["total"]["count"] == 3
+    ct.kill_coqtop()
+
+def test_normalize():
+    from sentences import normalize
+    assert normalize("  intro\n   n. ") == "intro n."
+    assert normalize("intro (* a (* nested *) comment *)n.") == "intro n."
+    assert normalize('Check "a  (* b *)"  .') == 'Check "a  (* b *)" .'
+    assert normalize("intro n.") != normalize("intro m.")
+    assert normalize("(* only *)") == ""
+
+def test_move_commands():
+    ct = launch_mock()
+    ct.advance(cmd1, (0, 10, 10))
+    ct.advance(cmd2, (1, 6, 6))
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    ct.pop_events()
+    # sync_commands compares the sentences in the buffer with it
+    assert ct.get_last_active_command().text == cmd2
+    ct.move_commands(2, [(2, 6, 6)])
+    assert ct.get_last_active_command().end == (2, 6, 6)
+    assert ct.count_active_commands_until(1, 6) == 2
+    assert ct.pop_events() == [StateChanged(2, Command.PROCESSED)]
+    ct.kill_coqtop()
+
+def test_move_commands_messages():
+    import command_colors as CC
+    ct = launch_mock()
+    ct.advance(cmd1, (0, 10, 10))
+    ct.advance(cmd2, (1, 6, 6))
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    comms = ct.get_active_commands()
+    for comm in comms[1:]:
+        comm.msg_type = Command.WARNING
+        comm.msg_start_offset = 0
+        comm.msg_stop_offset = 2
+    def convert_offset(start, offset, end):
+        return (start[0], start[1] + offset, start[2] + offset)
+    colors = CC.CommandColors(convert_offset)
+    colors.colors(comms[2], comms[1], True)
+    assert comms[2].msg_start == (0, 10, 10)
+    # The first command grows into the second one, which still ends where
+    # it did. Its message moves with its start.
+    ct.move_commands(1, [(0, 12, 12), (1, 6, 6)])
+    assert (CC.WARNINGS, CC.make_vim_range((0, 12, 12), (0, 14, 14))) in \
+        colors.colors(comms[2], comms[1], True)
+    ct.kill_coqtop()
+
+def test_goals_each():
+    ct = launch_mock()
+    ct.send_async([(cmd, (i, 1, 1)) for i, cmd in
+                   enumerate([cmd1, cmd2, cmd3])], goals_each=True)
+    while not ct.wait_for_result() & CoqTop.SEND_DONE:
+        pass
+    ct.finish_send()
+    # The goals of every state were cached on the way
+    for comm in ct.get_active_commands()[1:]:
+        goals = ct.get_cached_goals(comm.state_id)
+        assert goals.val.fg[0].ccl == 'goal 1 at state %d' % comm.state_id.id
+    ct.kill_coqtop()
+
+def test_profile():
+    import command_colors as CC
+    ct = launch_mock()
+    for i, cmd in enumerate([cmd1, cmd2, cmd3]):
+        ct.advance(cmd, (i, 1, 1))
+    while ct.has_unchecked_commands():
+        ct.process_response()
+    comms = ct.get_active_commands()
+    for comm in comms[1:]:
+        assert comm.submitted <= comm.started <= comm.finished
+        assert comm.worker == "proofworker:0"
+    # Pretend the second command was the slowest
+    comms[2].started = comms[2].finished - 5
+    slowest = ct.get_slowest_commands(2)
+    assert [comm for (d, start, comm) in slowest][0] is comms[2]
+    assert slowest[0][:2] == (5, comms[1].end)
+    assert len(slowest) == 2
+    colors = CC.CommandColors(None, slow_threshold=1)
+    assert (CC.SLOW, CC.make_vim_range(comms[1].end, comms[2].end)) in \
+        colors.colors(comms[2], comms[1], True)
+    assert all(g != CC.SLOW for (g, r) in
+               colors.colors(comms[3], comms[2], True))
+    ct.kill_coqtop()
+
+def test_goals_each_error():
+    # coqtop finds an error in the second sentence while the goals are
+    # fetched ahead
+    ct = launch_mock("--fail-goal-on", "bad")
+    sentences = [cmd1, "bad.", cmd3, "Qed."]
+    ct.send_async([(cmd, (i, 1, 1)) for i, cmd in enumerate(sentences)],
+                  goals_each=True)
+    while not ct.wait_for_result() & CoqTop.SEND_DONE:
+        pass
+    ct.finish_send()
+    # The queue stopped at the error, instead of going on from before it
+    comms = ct.get_active_commands()
+    assert [c.end for c in comms[1:]] == [(0, 1, 1)]
+    assert ct.cur_state() == comms[1].state_id
+    ct.kill_coqtop()
+
+def test_kill_while_sending():
+    import time
+    ct = launch_mock("--latency", "0.2")
+    ct.send_async([(cmd, (i, 1, 1)) for i, cmd in
+                   enumerate([cmd1, cmd2, cmd3])])
+    # Let the first Add be in flight
+    time.sleep(0.1)
+    ct.cancel_send()
+    ct.kill_coqtop()
+    ct.finish_send()
+    assert not ct.is_sending()
+    assert ct.states == []
+    assert ct.reverted_index == 0
+    # Only the removal of the commands is left to draw
+    assert ct.pop_events() == [CommandsRemoved(0)]
+    assert ct.restart_coq()
+    ct.advance(cmd1, (0, 1, 1))
+    assert ct.get_active_command_count() == 2
+    ct.kill_coqtop()